@@ -0,0 +1,126 @@
+"""Cold start: from launching the exporter to its first 200 responses.
+
+Each run starts a fresh exporter process, so the times include the
+interpreter and every import. It starts against the mock server, and again
+against a panel that is down, which must not keep it from starting:
+
+    python bench/coldstart.py --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import common
+
+ENDPOINTS = ("/healthz", "/ready", "/metrics")
+
+
+def get(url: str) -> int | None:
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def wait_for(url: str, timeout: float = 60) -> None:
+    until = time.monotonic() + timeout
+    while get(url) is None:
+        if time.monotonic() > until:
+            raise Exception(f"{url} didn't answer within {timeout}s")
+        time.sleep(0.05)
+
+
+def cold_start(
+    marzban_url: str, endpoints: tuple[str, ...], timeout: float
+) -> dict[str, float | None]:
+    """Seconds from launch to the first 200 of each endpoint, None if none came."""
+    port = common.free_port()
+    env = dict(
+        os.environ,
+        MARZBAN_URL=marzban_url,
+        MARZBAN_USERNAME="admin",
+        MARZBAN_PASSWORD="admin",
+    )
+    started = time.perf_counter()
+    exporter = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "exporter:app", "--port", str(port)],
+        cwd=common.SRC,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    first_ok = dict.fromkeys(endpoints)
+    try:
+        # /metrics also refreshes, so it is only asked once the others are done
+        for endpoint in endpoints:
+            while time.perf_counter() - started < timeout:
+                if exporter.poll() is not None:
+                    raise Exception(f"Exporter exited with {exporter.returncode}")
+                if get(f"http://127.0.0.1:{port}{endpoint}") == 200:
+                    first_ok[endpoint] = time.perf_counter() - started
+                    break
+                time.sleep(0.01)
+    finally:
+        exporter.terminate()
+        exporter.wait()
+    return first_ok
+
+
+def summary(runs: list[dict], endpoint: str) -> str:
+    times = [run[endpoint] for run in runs if run[endpoint] is not None]
+    if not times:
+        return f"{endpoint:>9}: no 200 within the timeout"
+    return (
+        f"{endpoint:>9}: median {statistics.median(times) * 1000:7.0f} ms, "
+        f"min {min(times) * 1000:7.0f} ms ({len(times)}/{len(runs)} runs)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    mock_port = common.free_port()
+    mock = subprocess.Popen(
+        [sys.executable, "mock_server.py"],
+        cwd=common.SRC,
+        env=dict(os.environ, MOCK_PORT=str(mock_port), MOCK_USERS=str(args.users)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(f"http://127.0.0.1:{mock_port}/api/core")
+        up = [
+            cold_start(f"http://127.0.0.1:{mock_port}", ENDPOINTS, 60)
+            for _ in range(args.runs)
+        ]
+    finally:
+        mock.terminate()
+        mock.wait()
+    # Nothing listens on a fresh free port, so every upstream request fails
+    # and only liveness can answer 200
+    down = [
+        cold_start(f"http://127.0.0.1:{common.free_port()}", ("/healthz",), 60)
+        for _ in range(args.runs)
+    ]
+
+    lines = [f"panel up, {args.users} users:"]
+    lines += [summary(up, endpoint) for endpoint in ENDPOINTS]
+    lines.append("panel down:")
+    lines.append(summary(down, "/healthz"))
+    common.report("Cold start", lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Shared helpers for the benchmarks in this directory.
+
+Run them from the repository root, e.g. ``python bench/soak.py``. Each one
+prints its results and appends them to bench_output.txt.
+"""
+
+import platform
+import socket
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+SRC = ROOT / "src"
+OUTPUT = ROOT / "bench_output.txt"
+
+# The exporter's modules import each other as top-level modules from src/
+sys.path.insert(0, str(SRC))
+
+
+def report(title: str, lines: list[str]):
+    when = time.strftime("%Y-%m-%d %H:%M:%S")
+    text = "\n".join(
+        [f"## {title} ({when}, Python {platform.python_version()})", *lines, ""]
+    )
+    print(text)
+    with OUTPUT.open("a") as output:
+        output.write(text + "\n")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def mock_client(app):
+    """A MarzbanAPI talking to the mock server in-process, without sockets."""
+    import httpx
+
+    import api
+
+    client = api.MarzbanAPI("http://mock", "admin", "admin")
+    client.client = httpx.AsyncClient(
+        base_url="http://mock/api", transport=httpx.ASGITransport(app=app)
+    )
+    client.tokens.client = client.client
+    return client
@@ -0,0 +1,96 @@
+"""Decode /users bodies: response.json() and dicts against the msgspec structs.
+
+Bodies come from the mock server's synthetic fleet, with its per-user
+padding standing in for the fields the collector doesn't read:
+
+    python bench/decode.py --users 1000 10000 100000
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import httpx
+import msgspec
+
+# Puts src/ on sys.path, so it comes before the exporter's modules
+import common
+import api
+import mock_server
+from models import UsersPage, decoders
+
+
+def dicts(body: bytes) -> int:
+    # What the collector did before the structs: parse everything, then .get()
+    data = httpx.Response(200, content=body).json()
+    total = 0
+    for user in data.get("users", []):
+        user.get("username", "unknown")
+        total += user.get("lifetime_used_traffic", 0)
+    return total
+
+
+def structs(body: bytes) -> int:
+    page = decoders[UsersPage].decode(body)
+    total = 0
+    for user in page.users:
+        user.username
+        total += user.lifetime_used_traffic
+    return total
+
+
+def stream(body: bytes) -> int:
+    # The unpaginated path, decoded as the chunks arrive
+    decoder = api.UsersStreamDecoder()
+    total = 0
+    for start in range(0, len(body), 65536):
+        total += sum(
+            user.lifetime_used_traffic
+            for user in decoder.feed(body[start : start + 65536])
+        )
+    return total + sum(user.lifetime_used_traffic for user in decoder.close())
+
+
+def best_time(decode, body: bytes, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(body)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def peak_memory(decode, body: bytes) -> int:
+    tracemalloc.start()
+    decode(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    paths = {"json+dict": dicts, "msgspec": structs, "stream": stream}
+    lines = [
+        f"{'users':>7} {'body MiB':>9} "
+        + " ".join(f"{name + ' ms':>13} {'peak MiB':>9}" for name in paths)
+    ]
+    for users in args.users:
+        fleet = mock_server.Fleet(1, users)
+        body = msgspec.json.encode({"users": fleet.user_page(0, None), "total": users})
+        assert len({decode(body) for decode in paths.values()}) == 1
+        columns = [f"{users:>7} {len(body) / 2**20:9.1f}"]
+        for decode in paths.values():
+            seconds = best_time(decode, body, args.repeat)
+            peak = peak_memory(decode, body)
+            columns.append(f"{seconds * 1000:13.1f} {peak / 2**20:9.1f}")
+        lines.append(" ".join(columns))
+    common.report("Decoding /users", lines)
+
+
+if __name__ == "__main__":
+    main()
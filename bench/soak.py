@@ -0,0 +1,76 @@
+"""Soak the collector: memory and exposition size over many refreshes.
+
+Every refresh builds a new snapshot, so after warm-up both should stay flat
+rather than grow with the number of refreshes:
+
+    python bench/soak.py --users 5000 --refreshes 500
+"""
+
+import argparse
+import asyncio
+import os
+import tracemalloc
+
+import common
+
+
+def rss() -> int | None:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+async def soak(refreshes: int, every: int) -> list[tuple]:
+    import api
+    import exposition
+    import mock_server
+
+    collection = api.PrometheusCollector(common.mock_client(mock_server.app))
+    cache = exposition.ExpositionCache(collection)
+    readings = []
+    tracemalloc.start()
+    for refresh in range(1, refreshes + 1):
+        await collection.refresh()
+        body, _ = await cache.get("text", "identity")
+        if refresh % every == 0 or refresh == 1:
+            heap, _ = tracemalloc.get_traced_memory()
+            readings.append((refresh, heap, rss(), len(body), body.count(b"\n")))
+    tracemalloc.stop()
+    await collection.api_client.close()
+    return readings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--refreshes", type=int, default=300)
+    parser.add_argument("--every", type=int, default=50)
+    args = parser.parse_args()
+    # The mock reads its fleet size when imported
+    os.environ["MOCK_USERS"] = str(args.users)
+    os.environ["MOCK_NODES"] = str(args.nodes)
+
+    readings = asyncio.run(soak(args.refreshes, args.every))
+    lines = [
+        f"{args.users} users, {args.nodes} nodes, {args.refreshes} refreshes",
+        f"{'refresh':>8} {'heap MiB':>9} {'RSS MiB':>8} {'body KiB':>9} {'lines':>7}",
+    ]
+    for refresh, heap, resident, size, count in readings:
+        resident = f"{resident / 2**20:8.1f}" if resident is not None else " " * 8
+        lines.append(
+            f"{refresh:>8} {heap / 2**20:9.1f} {resident} {size / 2**10:9.1f} {count:>7}"
+        )
+    # Compare against the second reading, once caches and buffers are warm
+    warm, last = readings[min(1, len(readings) - 1)], readings[-1]
+    lines.append(
+        f"growth after warm-up: heap {(last[1] - warm[1]) / 2**20:+.2f} MiB, "
+        f"body {last[3] - warm[3]:+d} bytes, lines {last[4] - warm[4]:+d}"
+    )
+    common.report("Soak", lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,196 +1,885 @@
+import asyncio
+import base64
+import binascii
+import contextvars
+import json
 import os
+import re
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import httpx
+import msgspec
 import prometheus_client as prom
 from dotenv import load_dotenv
 
+import catalog
+import instrumentation
+from cardinality import UserSeries
+from catalog import METRIC_GROUPS, METRICS, MetricSpec
+from counters import CounterState, CumulativeMetricFamily
+from histograms import DistributionMetricFamily
+from models import Core, Node, NodesUsage, System, User, UsersPage, decoders
+from rates import RateMetricFamily, RateState
+
 load_dotenv()
 
 MARZBAN_URL = os.getenv("MARZBAN_URL")
 MARZBAN_USERNAME = os.getenv("MARZBAN_USERNAME")
 MARZBAN_PASSWORD = os.getenv("MARZBAN_PASSWORD")
+EXPORTER_WORKERS = int(os.getenv("EXPORTER_WORKERS", "2"))
+# Users per /users page; 0 fetches the whole list in a single request
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "1000"))
+# How many /users pages may be in flight at once
+USERS_PAGE_CONCURRENCY = int(os.getenv("USERS_PAGE_CONCURRENCY", "4"))
+# Start of the period /nodes/usage sums traffic over. Without one Marzban
+# sums the last 30 days, which shrinks as old usage leaves the window, so
+# the default reaches back before any panel could have recorded traffic
+NODES_USAGE_START = os.getenv("NODES_USAGE_START", "2000-01-01T00:00:00")
+# Log in again this many seconds before the access token expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "60"))
+# Seconds an endpoint's metrics are fresh enough to serve without refreshing
+CACHE_MAX_AGE = float(os.getenv("CACHE_MAX_AGE", "0"))
+# Seconds past CACHE_MAX_AGE during which a scrape serves the cached metrics
+# right away and refreshes them in the background
+CACHE_STALE_WHILE_REVALIDATE = float(os.getenv("CACHE_STALE_WHILE_REVALIDATE", "0"))
+# Seconds the last good metrics keep being served while refreshes fail
+CACHE_STALE_IF_ERROR = float(os.getenv("CACHE_STALE_IF_ERROR", "300"))
+# Consecutive failures that open an endpoint's circuit breaker
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+# Seconds an open breaker waits before letting a trial request through
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
 
+# JSON decoding, sample building and rendering are CPU-bound and run here so
+# they never stall the event loop that serves /metrics
+executor = ThreadPoolExecutor(
+    max_workers=EXPORTER_WORKERS, thread_name_prefix="collector"
+)
+
+
+class SingleFlight:
+    """Share one in-flight call among concurrent callers asking for the same key.
+
+    Every caller that joins an existing call is counted in the
+    coalesced_requests metric under the given level.
+    """
+
+    def __init__(self, level: str):
+        self._calls = {}
+        self._coalesced = instrumentation.coalesced_requests.labels(level)
+
+    async def run(self, key, call):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(call())
+            self._calls[key] = task
+            task.add_done_callback(partial(self._forget, key))
+        else:
+            self._coalesced.inc()
+        # Shielded so one scraper giving up doesn't cancel the call for the rest
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task: asyncio.Task):
+        del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved even if every caller left
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# time.monotonic() by which the scrape being served must have its data; tasks
+# started on its behalf inherit it and size their upstream timeouts from it
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def remaining_budget() -> float | None:
+    if deadline.get() is None:
+        return None
+    remaining = deadline.get() - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Scrape deadline exceeded")
+    return remaining
+
+
+def endpoint_label(path: str) -> str:
+    """The endpoint label for a Marzban API path, in the same vocabulary as the
+    metric groups: "/nodes/usage" is "nodes_usage"."""
+    return path.strip("/").replace("/", "_")
+
+
+class CircuitBreaker:
+    """Stop calling an endpoint after repeated failures.
+
+    After BREAKER_FAILURE_THRESHOLD consecutive failures the breaker opens and
+    requests fail fast. Once BREAKER_RESET_TIMEOUT has passed a single trial
+    request is let through, and its outcome closes or reopens the breaker.
+    """
 
-class MarzbanAPI:
     def __init__(self):
-        self.client = httpx.Client(
-            base_url=f"{MARZBAN_URL}/api", follow_redirects=True, timeout=30
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self._trial or time.monotonic() - self.opened_at < BREAKER_RESET_TIMEOUT:
+            return False
+        self._trial = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def release(self):
+        """End a trial that was cut short, so the next request can be one."""
+        self._trial = False
+
+
+# A JSON string, and a number, true, false or null
+JSON_STRING = rb'"(?:[^"\\]++|\\.)*+"'
+JSON_SCALAR = rb'[^\s,:{}\[\]"]++'
+
+
+def json_value_pattern(depth: int) -> re.Pattern:
+    """Match a JSON value nested at most depth levels, without decoding it.
+
+    Brackets aren't paired up, msgspec checks that while decoding the value.
+    Every quantifier is possessive, so a value cut off by the end of a chunk
+    fails to match in linear time.
+    """
+    container = rb"(?!)"
+    for _ in range(depth):
+        container = (
+            rb"[{\[](?:" + JSON_STRING + rb'|[^{}\[\]"]++|' + container + rb")*+[}\]]"
         )
-        self.token = self._get_token()
+    return re.compile(JSON_STRING + b"|" + container + b"|" + JSON_SCALAR, re.DOTALL)
+
+
+class UsersStreamDecoder:
+    """Incrementally decode a /users body into User structs.
+
+    Feed it raw chunks as they arrive; each call returns the users completed so
+    far, so neither the full body nor the full object tree is ever held. The
+    users buffered so far are decoded by msgspec in one go, straight into User
+    structs, so the fields the collector doesn't read are skipped.
+    """
 
-    def _get_token(self) -> dict | None:
+    _whitespace = re.compile(rb"[ \t\n\r]*+")
+    # Values of the response other than the users, such as "total"
+    _values = json_value_pattern(16)
+    # Where a user may end: a "}" followed by "," and "{", or by "]"
+    _user_ends = re.compile(rb"\}(?=[ \t\n\r]*+(?:,[ \t\n\r]*+\{|\]))")
+
+    def __init__(self):
+        self.total = None
+        self._buffer = b""
+        self._pos = 0
+        self._state = "object"
+
+    def feed(self, chunk: bytes, final: bool = False) -> list[User]:
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        users = []
+        while self._step(users, final):
+            pass
+        return users
+
+    def close(self) -> list[User]:
+        users = self.feed(b"", final=True)
+        if self._state != "done":
+            raise Exception("Error decoding /users: truncated response")
+        return users
+
+    def _skip(self, delimiters: bytes = b"") -> bytes | None:
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos >= len(self._buffer):
+                return None
+            char = self._buffer[self._pos : self._pos + 1]
+            if char not in delimiters:
+                return char
+            self._pos += 1
+
+    def _value(self, final: bool) -> tuple | None:
+        match = self._values.match(self._buffer, self._pos)
+        # A value at the end of the buffer may continue in the next chunk
+        if match is None or (match.end() == len(self._buffer) and not final):
+            if final:
+                raise Exception("Error decoding /users: malformed response")
+            return None
+        self._pos = match.end()
+        try:
+            return (msgspec.json.decode(match[0]),)
+        except msgspec.DecodeError:
+            raise Exception("Error decoding /users: malformed response")
+
+    def _users(self, final: bool) -> list[User] | None:
+        """Decode the whole users buffered from the current position.
+
+        A cut after a "}" inside a string or a nested object leaves the list
+        malformed, so the last cut that decodes ends the last whole user.
+        """
+        cuts = [
+            match.end() for match in self._user_ends.finditer(self._buffer, self._pos)
+        ]
+        for cut in reversed(cuts):
+            try:
+                users = decoders[list[User]].decode(
+                    b"[" + self._buffer[self._pos : cut] + b"]"
+                )
+            except msgspec.ValidationError as e:
+                # Only the fields we read are checked, and those hold no
+                # brackets, so a bad cut can't be the cause
+                raise Exception(f"Unexpected response from /users: {e}")
+            except msgspec.DecodeError:
+                continue
+            self._pos = cut
+            return users
+        if final:
+            raise Exception("Error decoding /users: malformed response")
+        return None
+
+    def _step(self, users: list, final: bool) -> bool:
+        if self._state == "object":
+            if self._skip() is None:
+                return False
+            if self._buffer[self._pos : self._pos + 1] != b"{":
+                raise Exception("Error decoding /users: expected an object")
+            self._pos += 1
+            self._state = "key"
+        elif self._state == "key":
+            char = self._skip(b",")
+            if char is None:
+                return False
+            if char == b"}":
+                self._pos += 1
+                self._state = "done"
+                return False
+            start = self._pos
+            key = self._value(final)
+            if key is None or self._skip() is None:
+                self._pos = start
+                return False
+            if self._buffer[self._pos : self._pos + 1] != b":":
+                raise Exception("Error decoding /users: expected ':'")
+            self._pos += 1
+            if self._skip() is None:
+                self._pos = start
+                return False
+            if key[0] == "users":
+                if self._buffer[self._pos : self._pos + 1] != b"[":
+                    raise Exception("Error decoding /users: expected a list")
+                self._pos += 1
+                self._state = "users"
+                return True
+            value = self._value(final)
+            if value is None:
+                self._pos = start
+                return False
+            if key[0] == "total":
+                self.total = value[0]
+        elif self._state == "users":
+            char = self._skip(b",")
+            if char is None:
+                return False
+            if char == b"]":
+                self._pos += 1
+                self._state = "key"
+                return True
+            batch = self._users(final)
+            if batch is None:
+                return False
+            users.extend(batch)
+        else:
+            return False
+        return True
+
+
+class TokenManager:
+    """Keep a Marzban access token valid for the lifetime of the exporter.
+
+    The token is renewed TOKEN_REFRESH_MARGIN seconds before the "exp" claim of
+    the JWT, and concurrent callers share a single in-flight login instead of
+    each posting to /admin/token.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, username: str, password: str):
+        self.client = client
+        self.username = username
+        self.password = password
+        self.token = None
+        self.expires_at = None
+        self._login = None
+
+    async def get(self) -> str:
+        if self.token is None or (
+            self.expires_at is not None
+            and time.time() >= self.expires_at - TOKEN_REFRESH_MARGIN
+        ):
+            return await self.refresh()
+        return self.token
+
+    async def refresh(self, rejected: str | None = None) -> str:
+        # Another caller may already have replaced the token that got a 401
+        if rejected is not None and rejected != self.token:
+            return self.token
+        if self._login is None:
+            self._login = asyncio.create_task(self._get_token())
+        return await asyncio.shield(self._login)
+
+    async def _get_token(self) -> str:
+        started = time.perf_counter()
+        status = "error"
         try:
-            request = self.client.post(
+            response = await self.client.post(
                 "/admin/token",
-                data={"username": MARZBAN_USERNAME, "password": MARZBAN_PASSWORD},
-            ).json()["access_token"]
+                data={"username": self.username, "password": self.password},
+                timeout=remaining_budget() or self.client.timeout,
+            )
+            status = str(response.status_code)
+            response.raise_for_status()
+            self.token = response.json()["access_token"]
+            self.expires_at = self._expiry(self.token)
             print("Token successfully acquired!")
-            return request
-        except httpx.HTTPStatusError as e:
-            raise Exception(e)
+            return self.token
+        except httpx.HTTPError as e:
+            raise Exception(f"Error acquiring token: {str(e) or type(e).__name__}")
+        finally:
+            instrumentation.upstream_latency.labels(
+                endpoint_label("/admin/token"), status
+            ).observe(time.perf_counter() - started)
+            self._login = None
 
-    def _fetch(self, endpoint: str) -> dict:
+    @staticmethod
+    def _expiry(token: str) -> float | None:
         try:
-            response = self.client.get(
-                endpoint, headers={"Authorization": f"Bearer {self.token}"}
+            payload = token.split(".")[1]
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
             )
+            return float(claims["exp"])
+        except (IndexError, KeyError, TypeError, ValueError, binascii.Error):
+            # Not a JWT we can read: rely on 401 responses to trigger a login
+            return None
+
+
+class MarzbanAPI:
+    def __init__(
+        self,
+        url: str = MARZBAN_URL,
+        username: str = MARZBAN_USERNAME,
+        password: str = MARZBAN_PASSWORD,
+    ):
+        self.client = httpx.AsyncClient(
+            base_url=f"{url}/api", follow_redirects=True, timeout=30
+        )
+        self.tokens = TokenManager(self.client, username, password)
+        self._fetches = SingleFlight("fetch")
+        self._breakers = defaultdict(CircuitBreaker)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _send(
+        self, endpoint: str, params: dict | None = None, stream: bool = False
+    ) -> httpx.Response:
+        remaining_budget()
+        breaker = self._breakers[endpoint]
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {endpoint}, skipping request")
+        trial = breaker.opened_at is not None
+        try:
+            response = await self._request(endpoint, params, stream)
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            breaker.failure()
+            raise
+        finally:
+            # Running out of budget or being cancelled says nothing about the
+            # endpoint, but the trial must end or the breaker never lets
+            # another one through
+            if trial:
+                breaker.release()
+        breaker.success()
+        return response
+
+    async def _request(
+        self, endpoint: str, params: dict | None, stream: bool
+    ) -> httpx.Response:
+        token = await self.tokens.get()
+        try:
+            for retry in (True, False):
+                request = self.client.build_request(
+                    "GET",
+                    endpoint,
+                    params=params,
+                    headers={"Authorization": f"Bearer {token}"},
+                    timeout=remaining_budget() or self.client.timeout,
+                )
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    response = await self.client.send(request, stream=stream)
+                    status = str(response.status_code)
+                finally:
+                    # Streamed responses only count until their headers
+                    instrumentation.upstream_latency.labels(
+                        endpoint_label(endpoint), status
+                    ).observe(time.perf_counter() - started)
+                if response.status_code != 401 or not retry:
+                    break
+                # The token was revoked or expired early: log in once and retry
+                await response.aclose()
+                token = await self.tokens.refresh(token)
             response.raise_for_status()
-            return response.json()
-        except httpx.HTTPError as e:
+        except httpx.HTTPStatusError as e:
+            await e.response.aclose()
             raise Exception(f"Error fetching data from {endpoint}: {e}")
+        except httpx.HTTPError as e:
+            raise Exception(
+                f"Error fetching data from {endpoint}: {str(e) or type(e).__name__}"
+            )
+        return response
 
-    def fetch_nodes_data(self) -> dict:
-        return self._fetch("/nodes")
+    async def _fetch(self, endpoint: str, model, params: dict | None = None):
+        key = (endpoint, tuple(params.items()) if params else None)
+        return await self._fetches.run(
+            key, partial(self._fetch_once, endpoint, model, params)
+        )
 
-    def fetch_nodes_usage_data(self) -> dict:
-        return self._fetch("/nodes/usage")
+    async def _fetch_once(self, endpoint: str, model, params: dict | None):
+        response = await self._send(endpoint, params)
+        instrumentation.upstream_bytes.labels(endpoint_label(endpoint)).observe(
+            response.num_bytes_downloaded
+        )
+        try:
+            data, seconds = await asyncio.get_running_loop().run_in_executor(
+                executor,
+                instrumentation.timed,
+                decoders[model].decode,
+                response.content,
+            )
+        except msgspec.ValidationError as e:
+            raise Exception(f"Unexpected response from {endpoint}: {e}")
+        instrumentation.decode_duration.labels(endpoint_label(endpoint)).observe(
+            seconds
+        )
+        return data
+
+    async def fetch_nodes_data(self) -> list[Node]:
+        return await self._fetch("/nodes", list[Node])
+
+    async def fetch_nodes_usage_data(self) -> NodesUsage:
+        return await self._fetch(
+            "/nodes/usage", NodesUsage, {"start": NODES_USAGE_START}
+        )
 
-    def fetch_system_data(self) -> dict:
-        return self._fetch("/system")
+    async def fetch_system_data(self) -> System:
+        return await self._fetch("/system", System)
+
+    async def fetch_core_data(self) -> Core:
+        return await self._fetch("/core", Core)
+
+    async def _stream_users(self):
+        """Yield UsersPage batches from an unpaginated /users as it arrives.
+
+        The last batch also carries the "total" reported by the panel.
+        """
+        loop = asyncio.get_running_loop()
+        decoder = UsersStreamDecoder()
+        response = await self._send("/users", stream=True)
+        decoding = 0.0
+        try:
+            async for chunk in response.aiter_bytes(65536):
+                users, seconds = await loop.run_in_executor(
+                    executor, instrumentation.timed, decoder.feed, chunk
+                )
+                decoding += seconds
+                if users:
+                    yield UsersPage(users)
+        except httpx.HTTPError as e:
+            raise Exception(
+                f"Error fetching data from /users: {str(e) or type(e).__name__}"
+            )
+        finally:
+            await response.aclose()
+        users, seconds = await loop.run_in_executor(
+            executor, instrumentation.timed, decoder.close
+        )
+        instrumentation.upstream_bytes.labels("users").observe(
+            response.num_bytes_downloaded
+        )
+        instrumentation.decode_duration.labels("users").observe(decoding + seconds)
+        yield UsersPage(users, decoder.total)
 
-    def fetch_core_data(self) -> dict:
-        return self._fetch("/core")
+    async def fetch_users_data(self, offset: int = 0, limit: int = 0) -> UsersPage:
+        # Without a sort Marzban returns users in no particular order, so
+        # pages could overlap or skip users; new users sort last, so they
+        # don't shift the pages still to come
+        params = {"offset": offset, "limit": limit, "sort": "created_at"}
+        return await self._fetch("/users", UsersPage, params if limit else None)
 
-    def fetch_users_data(self) -> dict:
-        return self._fetch("/users")
+    async def iter_users_pages(self):
+        """Yield /users pages, keeping up to USERS_PAGE_CONCURRENCY in flight.
+
+        Pages are yielded in order and released by the caller once turned into
+        samples, so memory depends on the page size rather than the user count.
+        Pages can still overlap, as when users tie on the sort key, so users
+        already yielded are dropped from later pages. Without pagination the single response
+        is decoded as a stream instead.
+        """
+        if USERS_PAGE_SIZE <= 0:
+            async for batch in self._stream_users():
+                yield batch
+            return
+
+        seen = set()
+
+        def unseen(page: UsersPage) -> UsersPage:
+            # A new page rather than changing it: coalesced callers share it
+            users = [user for user in page.users if user.username not in seen]
+            seen.update(user.username for user in users)
+            return UsersPage(users, page.total)
+
+        page = await self.fetch_users_data(0, USERS_PAGE_SIZE)
+        total = page.total
+        yield unseen(page)
+
+        if total is None:
+            # Older panels don't report a total: walk pages until a short one
+            offset = USERS_PAGE_SIZE
+            while len(page.users) == USERS_PAGE_SIZE:
+                page = await self.fetch_users_data(offset, USERS_PAGE_SIZE)
+                offset += USERS_PAGE_SIZE
+                yield unseen(page)
+            return
+
+        offsets = iter(range(USERS_PAGE_SIZE, total, USERS_PAGE_SIZE))
+        pending = deque()
+        try:
+            for offset in offsets:
+                pending.append(
+                    asyncio.create_task(self.fetch_users_data(offset, USERS_PAGE_SIZE))
+                )
+                if len(pending) >= USERS_PAGE_CONCURRENCY:
+                    break
+            while pending:
+                page = await pending.popleft()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(
+                        asyncio.create_task(
+                            self.fetch_users_data(offset, USERS_PAGE_SIZE)
+                        )
+                    )
+                yield unseen(page)
+        finally:
+            for task in pending:
+                task.cancel()
 
 
 class PrometheusCollector(prom.CollectorRegistry):
-    def __init__(self, api_client: MarzbanAPI = MarzbanAPI()):
+    def __init__(self, api_client: MarzbanAPI):
         self.registry = prom.CollectorRegistry()
         self.api_client = api_client
+        # Refresh time and families of the last successful refresh of each
+        # endpoint. A refresh builds new families and swaps a new mapping in
+        # with one assignment, so collect() never sees a half-built scrape and
+        # samples never pile up across scrapes.
+        self._snapshot: dict[str, tuple[float, tuple]] = {}
+        self._failing = set()
+        self._background = set()
+        self._collections = SingleFlight("collection")
+        self._endpoint_refreshes = SingleFlight("endpoint")
+        # Reset detection state of the counters, and recent readings of the
+        # rates, by metric
+        self._counters = defaultdict(CounterState)
+        self._rates = defaultdict(RateState)
 
-        self.metrics = {
-            "node_usage_coefficient": prom.metrics_core.GaugeMetricFamily(
-                "node_usage_coefficient", "Node usage coefficient", labels=["node_name"]
-            ),
-            "node_address": prom.metrics_core.GaugeMetricFamily(
-                "node_info",
-                "Node address, port, API port, xray version, and status",
-                labels=[
-                    "node_name",
-                    "address",
-                    "port",
-                    "api_port",
-                    "xray_version",
-                    "status",
-                ],
-            ),
-            "node_uplink": prom.metrics_core.GaugeMetricFamily(
-                "node_uplink_bytes",
-                "Node uplink traffic in bytes",
-                labels=["node_name"],
-            ),
-            "node_downlink": prom.metrics_core.GaugeMetricFamily(
-                "node_downlink_bytes",
-                "Node downlink traffic in bytes",
-                labels=["node_name"],
-            ),
-            "system_version": prom.metrics_core.GaugeMetricFamily(
-                "system_version", "System version"
-            ),
-            "system_mem_total": prom.metrics_core.GaugeMetricFamily(
-                "system_memory_total_bytes", "Total system memory in bytes"
-            ),
-            "system_mem_used": prom.metrics_core.GaugeMetricFamily(
-                "system_memory_used_bytes", "Used system memory in bytes"
-            ),
-            "system_cpu_usage": prom.metrics_core.GaugeMetricFamily(
-                "system_cpu_usage_percent", "System CPU usage percentage"
-            ),
-            "system_total_users": prom.metrics_core.GaugeMetricFamily(
-                "system_total_users", "Total number of users in the system"
-            ),
-            "system_active_users": prom.metrics_core.GaugeMetricFamily(
-                "system_active_users", "Number of active users in the system"
-            ),
-            "system_incoming_bandwidth": prom.metrics_core.GaugeMetricFamily(
-                "system_incoming_bandwidth_bytes", "Total incoming bandwidth in bytes"
-            ),
-            "system_outgoing_bandwidth": prom.metrics_core.GaugeMetricFamily(
-                "system_outgoing_bandwidth_bytes", "Total outgoing bandwidth in bytes"
-            ),
-            "core_started": prom.metrics_core.GaugeMetricFamily(
-                "core_started", "Core started status"
-            ),
-            "total_users": prom.metrics_core.GaugeMetricFamily(
-                "total_users", "Total number of users"
-            ),
-            "user_traffic": prom.metrics_core.GaugeMetricFamily(
-                "user_lifetime_used_traffic_bytes",
-                "Lifetime used traffic per user in bytes",
-                labels=["username"],
-            ),
-        }
+    def _new_metrics(self, endpoint: str) -> dict:
+        return {key: self._new_family(key) for key in METRIC_GROUPS[endpoint]}
 
-    def collect(self):
-        self._collect_nodes_metrics()
-        self._collect_nodes_usage_metrics()
-        self._collect_system_metrics()
-        self._collect_core_metrics()
-        self._collect_users_metrics()
+    def _new_family(self, key: str):
+        spec: MetricSpec = METRICS[key]
+        if spec.kind == "counter":
+            return CumulativeMetricFamily(
+                spec.name, spec.documentation, spec.labels, self._counters[key]
+            )
+        if spec.kind == "rate":
+            return RateMetricFamily(
+                spec.name, spec.documentation, spec.labels, self._rates[key]
+            )
+        if spec.kind == "distribution":
+            return DistributionMetricFamily(spec.name, spec.documentation, spec.buckets)
+        return prom.metrics_core.GaugeMetricFamily(
+            spec.name, spec.documentation, labels=spec.labels
+        )
+
+    async def refresh(self, until: float | None = None):
+        """Refresh every endpoint that isn't fresh enough.
+
+        With a deadline (a time.monotonic() value) the upstream requests are
+        given only the time left, and the call returns by the deadline even if
+        some endpoints are still refreshing; those are served from cache or
+        skipped.
+        """
+        deadline.set(until)
+        refresh = asyncio.ensure_future(self._collections.run(None, self._refresh_all))
+        if until is None:
+            await refresh
+        else:
+            await asyncio.wait([refresh], timeout=until - time.monotonic())
+
+    async def _refresh_all(self):
+        await asyncio.gather(
+            *(self._refresh_cached(endpoint) for endpoint in METRIC_GROUPS)
+        )
 
-        yield from self.metrics.values()
+    async def _refresh_cached(self, endpoint: str):
+        age = self.age(endpoint)
+        if age < CACHE_MAX_AGE:
+            return
+        if age < CACHE_MAX_AGE + CACHE_STALE_WHILE_REVALIDATE:
+            task = asyncio.create_task(self.refresh_endpoint(endpoint))
+            self._background.add(task)
+            task.add_done_callback(self._background_done)
+            return
+        try:
+            await self.refresh_endpoint(endpoint)
+        except Exception as e:
+            # Keep serving the other endpoints, and this one's last good
+            # metrics for up to CACHE_STALE_IF_ERROR
+            print(f"Error refreshing {endpoint}: {e}")
+
+    def _background_done(self, task: asyncio.Task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error refreshing in background: {task.exception()}")
+
+    def age(self, endpoint: str) -> float:
+        """Seconds since the endpoint was last refreshed successfully."""
+        if endpoint not in self._snapshot:
+            return float("inf")
+        return time.monotonic() - self._snapshot[endpoint][0]
+
+    def up(self, endpoint: str) -> bool:
+        """Whether the endpoint has data and its last refresh succeeded."""
+        return endpoint in self._snapshot and endpoint not in self._failing
+
+    def ready(self) -> bool:
+        """Whether any endpoint has data to serve yet."""
+        return any(self.up(endpoint) for endpoint in METRIC_GROUPS)
+
+    async def refresh_endpoint(self, endpoint: str):
+        await self._endpoint_refreshes.run(
+            endpoint, partial(self._refresh_endpoint, endpoint)
+        )
+
+    async def _refresh_endpoint(self, endpoint: str):
+        try:
+            families = await self._build_endpoint(endpoint)
+        except Exception:
+            self._failing.add(endpoint)
+            raise
+        self._failing.discard(endpoint)
+        self._snapshot = {**self._snapshot, endpoint: (time.monotonic(), families)}
 
-    def _collect_nodes_metrics(self):
-        nodes = self.api_client.fetch_nodes_data()
+    async def _build_endpoint(self, endpoint: str) -> tuple:
+        metrics = self._new_metrics(endpoint)
+        if endpoint == "users":
+            collecting = await self._refresh_users(metrics)
+        else:
+            fetch, collect = {
+                "nodes": (
+                    self.api_client.fetch_nodes_data,
+                    self._collect_nodes_metrics,
+                ),
+                "nodes_usage": (
+                    self.api_client.fetch_nodes_usage_data,
+                    self._collect_nodes_usage_metrics,
+                ),
+                "system": (
+                    self.api_client.fetch_system_data,
+                    self._collect_system_metrics,
+                ),
+                "core": (self.api_client.fetch_core_data, self._collect_core_metrics),
+            }[endpoint]
+            data = await fetch()
+            _, collecting = await asyncio.get_running_loop().run_in_executor(
+                executor, instrumentation.timed, collect, metrics, data
+            )
+        instrumentation.collect_duration.labels(endpoint).observe(collecting)
+        families = tuple(metrics[name] for name in METRIC_GROUPS[endpoint])
+        instrumentation.collected_samples.labels(endpoint).observe(
+            sum(len(family.samples) for family in families)
+        )
+        for family in families:
+            if isinstance(family, (CumulativeMetricFamily, RateMetricFamily)):
+                family.commit()
+        return families
+
+    async def _refresh_users(self, metrics: dict) -> float:
+        """Build the users metrics, returning the seconds spent on samples."""
+        loop = asyncio.get_running_loop()
+        user_series = UserSeries(
+            metrics["user_traffic"], metrics["user_traffic_shards"]
+        )
+        total_users = 0
+        collecting = 0.0
+        async for page in self.api_client.iter_users_pages():
+            count, seconds = await loop.run_in_executor(
+                executor,
+                instrumentation.timed,
+                self._collect_users_metrics,
+                metrics,
+                page,
+                user_series,
+            )
+            total_users += count
+            collecting += seconds
+        metrics["total_users"].add_metric([], total_users)
+        for finish in (
+            user_series.finish,
+            metrics["user_traffic_distribution"].finish,
+            metrics["user_utilization_distribution"].finish,
+        ):
+            _, seconds = await loop.run_in_executor(
+                executor, instrumentation.timed, finish
+            )
+            collecting += seconds
+        return collecting
+
+    def _visible(self, snapshot: dict) -> list[str]:
+        # Endpoints failing for longer than CACHE_STALE_IF_ERROR are dropped
+        now = time.monotonic()
+        return [
+            endpoint
+            for endpoint in METRIC_GROUPS
+            if endpoint in snapshot
+            and not (
+                endpoint in self._failing
+                and now - snapshot[endpoint][0] > CACHE_STALE_IF_ERROR
+            )
+        ]
+
+    def describe(self):
+        # Registering with a registry then never runs collect()
+        return catalog.describe()
+
+    def groups(self) -> dict[str, tuple[float, tuple]]:
+        """Refresh time and families of each endpoint collect() yields, in order.
+
+        The families of an endpoint never change after it was refreshed, so
+        its refresh time identifies them.
+        """
+        snapshot = self._snapshot
+        return {endpoint: snapshot[endpoint] for endpoint in self._visible(snapshot)}
+
+    def collect(self):
+        for _, families in self.groups().values():
+            yield from families
+
+    def _collect_nodes_metrics(self, metrics: dict, nodes: list[Node]):
         for node in nodes:
-            node_name = node.get("name", "unknown")
-            self.metrics["node_usage_coefficient"].add_metric(
-                [node_name], node.get("usage_coefficient", 0)
+            metrics["node_usage_coefficient"].add_metric(
+                [node.name], node.usage_coefficient
             )
-            self.metrics["node_address"].add_metric(
+            metrics["node_address"].add_metric(
                 [
-                    str(node_name),
-                    str(node.get("address", "unknown")),
-                    str(node.get("port", "unknown")),
-                    str(node.get("api_port", "unknown")),
-                    str(node.get("xray_version", "unknown")),
-                    str(node.get("status", "unknown")),
+                    node.name,
+                    str(node.address),
+                    str(node.port),
+                    str(node.api_port),
+                    str(node.xray_version),
+                    str(node.status),
                 ],
                 1,  # Static value since this metric reflects node info
             )
 
-    def _collect_nodes_usage_metrics(self):
-        usage_data = self.api_client.fetch_nodes_usage_data()
-        for usage in usage_data.get("usages", []):
-            node_name = usage.get("node_name", "unknown")
-            self.metrics["node_uplink"].add_metric([node_name], usage.get("uplink", 0))
-            self.metrics["node_downlink"].add_metric(
-                [node_name], usage.get("downlink", 0)
-            )
+    def _collect_nodes_usage_metrics(self, metrics: dict, usage_data: NodesUsage):
+        for usage in usage_data.usages:
+            metrics["node_uplink"].add_total([usage.node_name], usage.uplink)
+            metrics["node_downlink"].add_total([usage.node_name], usage.downlink)
+            metrics["node_uplink_rate"].add_reading([usage.node_name], usage.uplink)
+            metrics["node_downlink_rate"].add_reading([usage.node_name], usage.downlink)
 
-    def _collect_system_metrics(self):
-        system_data = self.api_client.fetch_system_data()
-        self.metrics["system_version"].add_metric(
+    def _collect_system_metrics(self, metrics: dict, system_data: System):
+        metrics["system_version"].add_metric(
             [], 1
         )  # Static value just to represent the version presence
-        self.metrics["system_mem_total"].add_metric([], system_data.get("mem_total", 0))
-        self.metrics["system_mem_used"].add_metric([], system_data.get("mem_used", 0))
-        self.metrics["system_cpu_usage"].add_metric([], system_data.get("cpu_usage", 0))
-        self.metrics["system_total_users"].add_metric(
-            [], system_data.get("total_user", 0)
+        metrics["system_mem_total"].add_metric([], system_data.mem_total)
+        metrics["system_mem_used"].add_metric([], system_data.mem_used)
+        metrics["system_cpu_usage"].add_metric([], system_data.cpu_usage)
+        metrics["system_total_users"].add_metric([], system_data.total_user)
+        metrics["system_active_users"].add_metric([], system_data.users_active)
+        metrics["system_incoming_bandwidth"].add_metric(
+            [], system_data.incoming_bandwidth
         )
-        self.metrics["system_active_users"].add_metric(
-            [], system_data.get("users_active", 0)
+        metrics["system_outgoing_bandwidth"].add_metric(
+            [], system_data.outgoing_bandwidth
         )
-        self.metrics["system_incoming_bandwidth"].add_metric(
-            [], system_data.get("incoming_bandwidth", 0)
+        metrics["system_incoming_rate"].add_reading([], system_data.incoming_bandwidth)
+        metrics["system_outgoing_rate"].add_reading([], system_data.outgoing_bandwidth)
+
+    def _collect_core_metrics(self, metrics: dict, core_data: Core):
+        metrics["core_started"].add_metric([], int(core_data.started))
+
+    def _collect_users_metrics(
+        self, metrics: dict, users_data: UsersPage, user_series: UserSeries
+    ) -> int:
+        user_series.observe(users_data.users)
+        metrics["user_traffic_distribution"].observe(
+            user.lifetime_used_traffic for user in users_data.users
         )
-        self.metrics["system_outgoing_bandwidth"].add_metric(
-            [], system_data.get("outgoing_bandwidth", 0)
+        metrics["user_utilization_distribution"].observe(
+            user.used_traffic / user.data_limit
+            for user in users_data.users
+            if user.data_limit
         )
+        return len(users_data.users)
 
-    def _collect_core_metrics(self):
-        core_data = self.api_client.fetch_core_data()
-        self.metrics["core_started"].add_metric(
-            [], int(core_data.get("started", False))
-        )
 
-    def _collect_users_metrics(self):
-        users_data = self.api_client.fetch_users_data()
-        users = users_data.get("users", [])
-        self.metrics["total_users"].add_metric([], len(users))
-        for user in users:
-            username = user.get("username", "unknown")
-            traffic = user.get("lifetime_used_traffic", 0)
-            self.metrics["user_traffic"].add_metric([username], traffic)
+class EndpointStatusCollector:
+    """Report how fresh and healthy each endpoint of a collector is.
+
+    Kept apart from PrometheusCollector because these values change between
+    refreshes and are computed at scrape time.
+    """
+
+    def __init__(self, collector: PrometheusCollector):
+        self.collector = collector
+
+    def collect(self):
+        age = prom.metrics_core.GaugeMetricFamily(
+            "marzban_exporter_endpoint_data_age_seconds",
+            "Seconds since the metrics from a Marzban endpoint were last refreshed",
+            labels=["endpoint"],
+        )
+        up = prom.metrics_core.GaugeMetricFamily(
+            "marzban_exporter_endpoint_up",
+            "Whether the last refresh of a Marzban endpoint succeeded",
+            labels=["endpoint"],
+        )
+        for endpoint in METRIC_GROUPS:
+            age.add_metric([endpoint], self.collector.age(endpoint))
+            up.add_metric([endpoint], int(self.collector.up(endpoint)))
+        yield age
+        yield up
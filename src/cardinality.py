@@ -0,0 +1,83 @@
+import heapq
+import os
+import re
+import zlib
+from typing import Iterable
+
+import prometheus_client as prom
+
+from counters import CumulativeMetricFamily
+from models import User
+
+# Which users get a user_lifetime_used_traffic_bytes series: "all", "top"
+# (the USER_SERIES_TOP_K users with the most traffic), "shards" (traffic
+# summed into USER_SERIES_SHARDS hash shards instead) or "none"
+USER_SERIES = os.getenv("USER_SERIES", "all").lower()
+USER_SERIES_TOP_K = int(os.getenv("USER_SERIES_TOP_K", "100"))
+USER_SERIES_SHARDS = int(os.getenv("USER_SERIES_SHARDS", "16"))
+# Regular expressions a username must match in full to be (or not be) exported
+USER_SERIES_ALLOW = os.getenv("USER_SERIES_ALLOW")
+USER_SERIES_DENY = os.getenv("USER_SERIES_DENY")
+
+if USER_SERIES not in ("all", "top", "shards", "none"):
+    raise Exception(f"Unknown USER_SERIES mode {USER_SERIES}")
+
+
+class UserSeries:
+    """Pick the per-user series of a refresh, one /users page at a time.
+
+    Top-K keeps a heap of K users rather than sorting everyone, and shards
+    keep one sum each. Every selected user's counter is tracked either way,
+    so a user entering the top K has no false reset.
+    """
+
+    def __init__(
+        self,
+        per_user: CumulativeMetricFamily,
+        per_shard: prom.metrics_core.GaugeMetricFamily,
+        mode: str = USER_SERIES,
+    ):
+        self.per_user = per_user
+        self.per_shard = per_shard
+        self.mode = mode
+        self._allow = re.compile(USER_SERIES_ALLOW) if USER_SERIES_ALLOW else None
+        self._deny = re.compile(USER_SERIES_DENY) if USER_SERIES_DENY else None
+        self._top = []
+        self._shards = [0] * USER_SERIES_SHARDS
+
+    def wanted(self, username: str) -> bool:
+        if self._allow is not None and not self._allow.fullmatch(username):
+            return False
+        return self._deny is None or not self._deny.fullmatch(username)
+
+    def observe(self, users: Iterable[User]):
+        if self.mode == "none":
+            return
+        for user in users:
+            if not self.wanted(user.username):
+                continue
+            # Every selected user is tracked, even if not exported this time
+            traffic, created = self.per_user.total(
+                [user.username], user.lifetime_used_traffic
+            )
+            if self.mode == "all":
+                self.per_user.add_metric([user.username], traffic, created)
+            elif self.mode == "top":
+                entry = (traffic, user.username, created)
+                if len(self._top) < USER_SERIES_TOP_K:
+                    heapq.heappush(self._top, entry)
+                elif entry > self._top[0]:
+                    heapq.heapreplace(self._top, entry)
+            else:
+                # crc32 rather than hash(), so users keep their shard across restarts
+                shard = zlib.crc32(user.username.encode()) % USER_SERIES_SHARDS
+                self._shards[shard] += traffic
+
+    def finish(self):
+        """Add the selected series, once every user has been observed."""
+        if self.mode == "top":
+            for traffic, username, created in sorted(self._top, reverse=True):
+                self.per_user.add_metric([username], traffic, created)
+        elif self.mode == "shards":
+            for shard, traffic in enumerate(self._shards):
+                self.per_shard.add_metric([str(shard)], traffic)
@@ -0,0 +1,164 @@
+import os
+from typing import NamedTuple
+
+import prometheus_client as prom
+
+from histograms import parse_buckets
+
+# Upper bounds of the classic buckets of the user traffic histogram, in bytes
+USER_TRAFFIC_BUCKETS = parse_buckets(
+    os.getenv("USER_TRAFFIC_BUCKETS", "1e8,1e9,1e10,1e11,1e12")
+)
+# Upper bounds of the classic buckets of the data limit utilization histogram
+USER_UTILIZATION_BUCKETS = parse_buckets(
+    os.getenv("USER_UTILIZATION_BUCKETS", "0.25,0.5,0.75,0.9,1")
+)
+
+
+class MetricSpec(NamedTuple):
+    # Marzban endpoint the metric is built from
+    endpoint: str
+    # "gauge", "counter" (a cumulative total with reset detection), "rate"
+    # (bytes/sec gauges of a cumulative total) or "distribution" (histogram)
+    kind: str
+    name: str
+    documentation: str
+    labels: tuple[str, ...] = ()
+    buckets: tuple[float, ...] = ()
+
+    def describe(self) -> prom.metrics_core.Metric:
+        """An empty family with the name and type the metric is collected as."""
+        typ = {"counter": "counter", "distribution": "histogram"}.get(self.kind)
+        return prom.metrics_core.Metric(self.name, self.documentation, typ or "gauge")
+
+
+# Every metric the collector exposes, by key
+METRICS = {
+    "node_usage_coefficient": MetricSpec(
+        "nodes",
+        "gauge",
+        "node_usage_coefficient",
+        "Node usage coefficient",
+        ("node_name",),
+    ),
+    "node_address": MetricSpec(
+        "nodes",
+        "gauge",
+        "node_info",
+        "Node address, port, API port, xray version, and status",
+        ("node_name", "address", "port", "api_port", "xray_version", "status"),
+    ),
+    "node_uplink": MetricSpec(
+        "nodes_usage",
+        "counter",
+        "node_uplink_bytes",
+        "Node uplink traffic in bytes",
+        ("node_name",),
+    ),
+    "node_downlink": MetricSpec(
+        "nodes_usage",
+        "counter",
+        "node_downlink_bytes",
+        "Node downlink traffic in bytes",
+        ("node_name",),
+    ),
+    "node_uplink_rate": MetricSpec(
+        "nodes_usage",
+        "rate",
+        "node_uplink_bytes_per_second",
+        "Node uplink traffic per second over a window",
+        ("node_name",),
+    ),
+    "node_downlink_rate": MetricSpec(
+        "nodes_usage",
+        "rate",
+        "node_downlink_bytes_per_second",
+        "Node downlink traffic per second over a window",
+        ("node_name",),
+    ),
+    "system_version": MetricSpec("system", "gauge", "system_version", "System version"),
+    "system_mem_total": MetricSpec(
+        "system", "gauge", "system_memory_total_bytes", "Total system memory in bytes"
+    ),
+    "system_mem_used": MetricSpec(
+        "system", "gauge", "system_memory_used_bytes", "Used system memory in bytes"
+    ),
+    "system_cpu_usage": MetricSpec(
+        "system", "gauge", "system_cpu_usage_percent", "System CPU usage percentage"
+    ),
+    "system_total_users": MetricSpec(
+        "system", "gauge", "system_total_users", "Total number of users in the system"
+    ),
+    "system_active_users": MetricSpec(
+        "system",
+        "gauge",
+        "system_active_users",
+        "Number of active users in the system",
+    ),
+    "system_incoming_bandwidth": MetricSpec(
+        "system",
+        "gauge",
+        "system_incoming_bandwidth_bytes",
+        "Total incoming bandwidth in bytes",
+    ),
+    "system_outgoing_bandwidth": MetricSpec(
+        "system",
+        "gauge",
+        "system_outgoing_bandwidth_bytes",
+        "Total outgoing bandwidth in bytes",
+    ),
+    "system_incoming_rate": MetricSpec(
+        "system",
+        "rate",
+        "system_incoming_bandwidth_bytes_per_second",
+        "Incoming traffic per second over a window",
+    ),
+    "system_outgoing_rate": MetricSpec(
+        "system",
+        "rate",
+        "system_outgoing_bandwidth_bytes_per_second",
+        "Outgoing traffic per second over a window",
+    ),
+    "core_started": MetricSpec("core", "gauge", "core_started", "Core started status"),
+    "total_users": MetricSpec("users", "gauge", "total_users", "Total number of users"),
+    "user_traffic": MetricSpec(
+        "users",
+        "counter",
+        "user_lifetime_used_traffic_bytes",
+        "Lifetime used traffic per user in bytes",
+        ("username",),
+    ),
+    "user_traffic_shards": MetricSpec(
+        "users",
+        "gauge",
+        "users_shard_lifetime_used_traffic_bytes",
+        "Lifetime used traffic of the users in a hash shard in bytes",
+        ("shard",),
+    ),
+    "user_traffic_distribution": MetricSpec(
+        "users",
+        "distribution",
+        "users_lifetime_used_traffic_bytes",
+        "Distribution of lifetime used traffic across users in bytes",
+        buckets=USER_TRAFFIC_BUCKETS,
+    ),
+    "user_utilization_distribution": MetricSpec(
+        "users",
+        "distribution",
+        "users_data_limit_utilization_ratio",
+        "Distribution of used traffic as a fraction of the data limit across "
+        "users that have one",
+        buckets=USER_UTILIZATION_BUCKETS,
+    ),
+}
+
+# Marzban endpoints the collector scrapes, and the metrics built from each
+METRIC_GROUPS = {
+    endpoint: tuple(key for key, spec in METRICS.items() if spec.endpoint == endpoint)
+    for endpoint in ("nodes", "nodes_usage", "system", "core", "users")
+}
+
+
+def describe():
+    """Empty families for every metric in the catalog, for describe()."""
+    return [spec.describe() for spec in METRICS.values()]
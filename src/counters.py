@@ -0,0 +1,69 @@
+import os
+import time
+from typing import Sequence
+
+import prometheus_client as prom
+
+# Same switch as prometheus_client's own: leave out the _created series
+CREATED_SERIES = (
+    os.getenv("PROMETHEUS_DISABLE_CREATED_SERIES", "false").lower() != "true"
+)
+
+
+class CounterState:
+    """Last total, reset offset and creation time of each series of a counter,
+    carried from one refresh to the next."""
+
+    def __init__(self):
+        self.series: dict[tuple, tuple[float, float, float | None]] = {}
+        # Whether a refresh was committed, so a new series was seen to start
+        self.committed = False
+
+
+class CumulativeMetricFamily(prom.metrics_core.CounterMetricFamily):
+    """A counter built from totals that Marzban may reset.
+
+    A total lower than the one seen in the previous refresh is taken as a
+    reset, and the previous total is carried as an offset, so the exposed
+    counter never decreases. Only a series that appears after the first
+    refresh, such as a new user, is known to have started recently; it is
+    created when first seen. Series present from the start have no creation
+    time, since their totals predate the exporter. commit() makes this refresh
+    the previous one, which also forgets the series it didn't see.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str],
+        state: CounterState,
+    ):
+        super().__init__(name, documentation, labels=labels)
+        self.state = state
+        self.series = {}
+        self.now = time.time()
+
+    def total(self, labels: Sequence[str], value: float) -> tuple[float, float | None]:
+        """Monotonic total and creation time of the series for Marzban's total."""
+        key = tuple(labels)
+        if key in self.state.series:
+            last, offset, created = self.state.series[key]
+            if value < last:
+                offset += last
+        else:
+            offset, created = 0, self.now if self.state.committed else None
+        self.series[key] = (value, offset, created)
+        return offset + value, created
+
+    def add_total(self, labels: Sequence[str], value: float):
+        self.add_metric(labels, *self.total(labels, value))
+
+    def add_metric(self, labels, value, created=None, timestamp=None):
+        super().add_metric(
+            labels, value, created if CREATED_SERIES else None, timestamp
+        )
+
+    def commit(self):
+        self.state.series = self.series
+        self.state.committed = True
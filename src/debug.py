@@ -0,0 +1,174 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+import api
+import instrumentation
+
+# Serve /debug/profile and /debug/heap; they expose internals and slow the
+# exporter down while they run
+DEBUG_ENDPOINTS = os.getenv("DEBUG_ENDPOINTS", "false").lower() == "true"
+# If set, the debug endpoints also require "Authorization: Bearer <token>"
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+# Longest capture a debug endpoint may be asked for, in seconds
+DEBUG_MAX_SECONDS = float(os.getenv("DEBUG_MAX_SECONDS", "60"))
+# Stack frames tracemalloc keeps per allocation for /debug/heap
+DEBUG_HEAP_FRAMES = int(os.getenv("DEBUG_HEAP_FRAMES", "10"))
+
+# One capture at a time: profilers and tracemalloc are process-wide
+capturing = asyncio.Lock()
+
+# Before Python 3.12 a profiler only sees the thread that enabled it. Since
+# then it uses sys.monitoring, which sees every thread but allows just one
+# active profiler per process.
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)
+
+
+def refusal(authorization: str | None) -> int | None:
+    """HTTP status to refuse a debug request with, or None to serve it."""
+    if not DEBUG_ENDPOINTS:
+        return 404
+    if DEBUG_TOKEN and not hmac.compare_digest(
+        authorization or "", f"Bearer {DEBUG_TOKEN}"
+    ):
+        return 403
+    return None
+
+
+def _refreshes() -> float:
+    """Endpoint refreshes completed so far, by the exporter's own metrics."""
+    return sum(
+        instrumentation.registry.get_sample_value(
+            "marzban_exporter_collect_duration_seconds_count", {"endpoint": endpoint}
+        )
+        or 0
+        for endpoint in api.METRIC_GROUPS
+    )
+
+
+async def _await_cycles(seconds: float) -> str:
+    """Wait while scrapes or the pollers run their cycles, and summarize them.
+
+    No cycles are run on top of those: a capture during an incident would
+    otherwise hammer a struggling panel back to back.
+    """
+    before = _refreshes()
+    await asyncio.sleep(seconds)
+    refreshes = _refreshes() - before
+    summary = f"{refreshes:.0f} endpoint refreshes in {seconds:g}s\n"
+    if not refreshes:
+        summary += "Nothing was collected; scrape /metrics during the capture\n"
+    return summary + "\n"
+
+
+async def _on_each_worker(call):
+    """Run call once in every executor thread.
+
+    Every call waits for the others, so no worker can take two of them.
+    """
+    barrier = threading.Barrier(api.EXPORTER_WORKERS)
+
+    def run():
+        barrier.wait(timeout=10)
+        return call()
+
+    loop = asyncio.get_running_loop()
+    # Wait for every call even if one fails, so none is still running after
+    results = await asyncio.gather(
+        *(loop.run_in_executor(api.executor, run) for _ in range(api.EXPORTER_WORKERS)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def _stop_on_workers(
+    starting: asyncio.Future | None, profiles: dict, running: set
+):
+    """Disable the worker profilers, each from the thread it was enabled in."""
+    if starting is not None:
+        await asyncio.wait([starting])
+
+    def stop():
+        if threading.get_ident() in running:
+            profiles[threading.get_ident()].disable()
+            running.discard(threading.get_ident())
+
+    # No barrier: a worker may take several calls, so repeat until all stopped
+    loop = asyncio.get_running_loop()
+    while running:
+        await asyncio.gather(
+            *(loop.run_in_executor(api.executor, stop) for _ in range(len(running)))
+        )
+
+
+async def profile(seconds: float, limit: int) -> str:
+    """cProfile the collection cycles of the next seconds.
+
+    Before Python 3.12 the event loop thread and every executor worker get a
+    profiler of their own, and their stats are merged.
+    """
+    async with capturing:
+        profiles = {}
+        running = set()
+
+        def start():
+            profiler = cProfile.Profile()
+            profiler.enable()
+            profiles[threading.get_ident()] = profiler
+            running.add(threading.get_ident())
+
+        loop_profile = cProfile.Profile()
+        starting = None
+        try:
+            if PER_THREAD_PROFILERS:
+                starting = asyncio.ensure_future(_on_each_worker(start))
+                await asyncio.shield(starting)
+            loop_profile.enable()
+            summary = await _await_cycles(seconds)
+        finally:
+            # Also after a failed or cancelled start, so no profiler keeps running
+            loop_profile.disable()
+            await asyncio.shield(_stop_on_workers(starting, profiles, running))
+
+    output = io.StringIO()
+    stats = pstats.Stats(loop_profile, stream=output)
+    for worker_profile in profiles.values():
+        stats.add(worker_profile)
+    # Idle workers block on the executor's queue, which isn't collection work
+    for key in list(stats.stats):
+        if key[2] == "<method 'get' of '_queue.SimpleQueue' objects>":
+            del stats.stats[key]
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    return summary + output.getvalue()
+
+
+async def heap(seconds: float, limit: int) -> str:
+    """Top allocation growth by line over the collection cycles of the next seconds."""
+    async with capturing:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(DEBUG_HEAP_FRAMES)
+        try:
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+            summary = await _await_cycles(seconds)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    differences = await asyncio.to_thread(
+        after.filter_traces(ignore).compare_to,
+        before.filter_traces(ignore),
+        "lineno",
+    )
+    return summary + "".join(f"{difference}\n" for difference in differences[:limit])
@@ -1,17 +1,151 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
 import api
-from fastapi import FastAPI
+import debug
+import exposition
+import instrumentation
+import poller
+import probe
+from fastapi import FastAPI, Request, Response
 import prometheus_client as prom
 
+# Seconds of Prometheus' scrape timeout kept for rendering and sending the
+# response, the rest is the budget for upstream requests
+SCRAPE_TIMEOUT_OFFSET = float(os.getenv("SCRAPE_TIMEOUT_OFFSET", "0.5"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nothing here talks to Marzban: clients log in on their first request,
+    # so a panel that is down delays readiness rather than startup
+    targets = probe.TargetPool(probe.load_targets(probe.TARGETS_FILE))
+    if probe.FLEET_MODE:
+        # Otherwise /metrics would serve nothing but look healthy
+        if not targets.targets:
+            raise Exception("FLEET_MODE needs at least one target in TARGETS_FILE")
+        # What /metrics refreshes and serves
+        collection = probe.FleetCollector(targets)
+        status = probe.FleetStatusCollector(targets)
+        collectors = list(targets.collectors().values())
+    else:
+        collection = api.PrometheusCollector(api.MarzbanAPI())
+        status = api.EndpointStatusCollector(collection)
+        collectors = [collection]
+
+    # Marzban metrics only change when a snapshot is refreshed and are rendered
+    # once per refresh; the exporter's own metrics are rendered on every scrape
+    app.state.targets = targets
+    app.state.collection = collection
+    app.state.snapshot_cache = exposition.ExpositionCache(collection)
+    instrumentation.registry.register(status)
+
+    pollers = []
+    warmup = None
+    if poller.BACKGROUND_POLLING:
+        pollers = [poller.Poller(collector) for collector in collectors]
+        for background in pollers:
+            background.start()
+    else:
+        # Fill the snapshot in the background so the first scrape is quick
+        warmup = asyncio.create_task(collection.refresh())
+    yield
+    if warmup is not None:
+        warmup.cancel()
+    for background in pollers:
+        await background.stop()
+    instrumentation.registry.unregister(status)
+    if not probe.FLEET_MODE:
+        await collection.api_client.close()
+    await targets.close()
 
-api_client = api.PrometheusCollector()
-app = FastAPI()
 
-registry = prom.CollectorRegistry()
-registry.register(api_client)
+app = FastAPI(lifespan=lifespan)
 
-prom.REGISTRY.register(api_client)
+
+def scrape_deadline(request: Request) -> float | None:
+    try:
+        timeout = float(request.headers["X-Prometheus-Scrape-Timeout-Seconds"])
+    except (KeyError, ValueError):
+        return None
+    return time.monotonic() + timeout - SCRAPE_TIMEOUT_OFFSET
 
 
 @app.get("/metrics")
-async def metrics():
-    return prom.generate_latest(registry)
+async def metrics(request: Request):
+    state = request.app.state
+    if not poller.BACKGROUND_POLLING:
+        await state.collection.refresh(scrape_deadline(request))
+    fmt = exposition.negotiate_format(request.headers.get("Accept", ""))
+    encoding = exposition.negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    vary = {"Vary": "Accept, Accept-Encoding"}
+    # The ETag covers the Marzban metrics only, so answering 304 leaves the
+    # scraper with its older copy of the exporter's own metrics
+    etag = state.snapshot_cache.etag(fmt)
+    if exposition.etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, **vary})
+    body, etag = await exposition.render(
+        state.snapshot_cache, instrumentation.registry, fmt, encoding
+    )
+    headers = {"ETag": etag, **vary}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        body, media_type=exposition.FORMATS[fmt].content_type, headers=headers
+    )
+
+
+@app.get("/probe")
+async def probe_target(request: Request, target: str):
+    collector = request.app.state.targets.get(target)
+    if collector is None:
+        return Response(f"Unknown target {target}\n", status_code=404)
+    started = time.monotonic()
+    await collector.refresh(scrape_deadline(request))
+    target_registry = probe.probe_registry(collector, time.monotonic() - started)
+    output = await asyncio.get_running_loop().run_in_executor(
+        api.executor, prom.generate_latest, target_registry
+    )
+    return Response(output, media_type=prom.CONTENT_TYPE_LATEST)
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the exporter is running, whatever the state of Marzban."""
+    return Response("ok\n")
+
+
+@app.get("/ready")
+async def ready(request: Request):
+    """Readiness: there are Marzban metrics to serve."""
+    if request.app.state.collection.ready():
+        return Response("ready\n")
+    return Response("not ready\n", status_code=503)
+
+
+async def _debug_capture(request: Request, capture, seconds: float, limit: int):
+    status = debug.refusal(request.headers.get("Authorization"))
+    if status is not None:
+        return Response(status_code=status)
+    if not 0 < seconds <= debug.DEBUG_MAX_SECONDS:
+        return Response(
+            f"seconds must be between 0 and {debug.DEBUG_MAX_SECONDS}\n",
+            status_code=400,
+        )
+    if debug.capturing.locked():
+        return Response("Another capture is running\n", status_code=409)
+    return Response(await capture(seconds, limit))
+
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10, limit: int = 50):
+    """cProfile stats of the collection cycles in the next seconds."""
+    return await _debug_capture(request, debug.profile, seconds, limit)
+
+
+@app.get("/debug/heap")
+async def debug_heap(request: Request, seconds: float = 10, limit: int = 25):
+    """Top tracemalloc growth over the collection cycles in the next seconds."""
+    return await _debug_capture(request, debug.heap, seconds, limit)
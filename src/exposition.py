@@ -0,0 +1,348 @@
+import asyncio
+import hashlib
+import os
+import struct
+import time
+import zlib
+from typing import Callable, NamedTuple
+
+import prometheus_client as prom
+import zstandard
+from prometheus_client import openmetrics
+
+import api
+import instrumentation
+import protobuf
+
+
+class Identity:
+    def part(self, data: bytes) -> bytes:
+        return data
+
+    def join(self, datas: list[bytes], parts: list[bytes]) -> bytes:
+        return b"".join(parts)
+
+    def finish(self, prefix: bytes, data: bytes) -> bytes:
+        return prefix + data
+
+
+class Gzip:
+    """Gzip cached parts once each, then join them and finish with new data.
+
+    Every part is deflated on its own and ends with a sync flush, so parts
+    and the data can follow each other as blocks of the same member; some
+    decoders stop after the first member, so one member per part isn't an
+    option.
+    """
+
+    header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+    def part(self, data: bytes) -> bytes:
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return deflate.compress(data) + deflate.flush(zlib.Z_SYNC_FLUSH)
+
+    def join(self, datas: list[bytes], parts: list[bytes]) -> tuple[bytes, int, int]:
+        # Checksumming is fast next to deflating, so it is redone on every join
+        crc = 0
+        for data in datas:
+            crc = zlib.crc32(data, crc)
+        return b"".join(parts), crc, sum(map(len, datas))
+
+    def finish(self, prefix: tuple[bytes, int, int], data: bytes) -> bytes:
+        blocks, crc, size = prefix
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        trailer = struct.pack(
+            "<II", zlib.crc32(data, crc), (size + len(data)) & 0xFFFFFFFF
+        )
+        return b"".join(
+            (self.header, blocks, deflate.compress(data), deflate.flush(), trailer)
+        )
+
+
+class Zstd:
+    """Zstandard-compress joined parts once, then finish the frame per response.
+
+    Compressed blocks depend on the blocks before them in the frame, so parts
+    compressed apart can't be joined; the join is compressed as a whole, once
+    per change to any part, which at level 3 costs little next to rendering.
+    Its blocks don't end the frame, and the data follows as raw blocks. The
+    header is rewritten with the total size, so the response is one frame
+    that even decoders needing the content size read in full. The data is the
+    small live part, so leaving it uncompressed costs little.
+    """
+
+    magic = b"\x28\xb5\x2f\xfd"
+    # Largest block the format allows
+    block_size = 128 * 1024
+
+    def part(self, data: bytes) -> bytes:
+        return data
+
+    def join(self, datas: list[bytes], parts: list[bytes]) -> tuple[int, bytes, int]:
+        data = b"".join(parts)
+        compressor = zstandard.ZstdCompressor(
+            level=3, write_checksum=False, write_content_size=False
+        ).compressobj()
+        frame = compressor.compress(data) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+        if not frame:
+            return 0, b"", 0
+        # Configured as above, the header is the magic number, an empty frame
+        # header descriptor and the window descriptor
+        if frame[:4] != self.magic or frame[4] != 0:
+            raise Exception("Unexpected zstd frame header")
+        return frame[5], frame[6:], len(data)
+
+    def finish(self, prefix: tuple[int, bytes, int], data: bytes) -> bytes:
+        window, blocks, size = prefix
+        # Frame header descriptor 0xc0: an 8-byte content size and a window
+        # descriptor follow
+        parts = [self.magic, bytes((0xC0, window)), struct.pack("<Q", size + len(data))]
+        parts.append(blocks)
+        # Raw blocks may not exceed the window either
+        exponent, mantissa = window >> 3, window & 7
+        window_size = (1 << (10 + exponent)) * (8 + mantissa) // 8
+        limit = min(self.block_size, window_size)
+        chunks = [data[start : start + limit] for start in range(0, len(data), limit)]
+        for index, chunk in enumerate(chunks or [b""]):
+            last = index == max(len(chunks) - 1, 0)
+            # 3-byte little-endian block header: size, block type 0 (raw), last
+            parts.append(struct.pack("<I", len(chunk) << 3 | last)[:3])
+            parts.append(chunk)
+        return b"".join(parts)
+
+
+# Content encodings we can serve, in order of preference
+ENCODINGS = {"zstd": Zstd(), "gzip": Gzip(), "identity": Identity()}
+
+
+class Format(NamedTuple):
+    media_type: str
+    content_type: str
+    generate: Callable[[prom.CollectorRegistry], bytes]
+    # Closes an exposition; only the live part keeps it when joining the two
+    trailer: bytes = b""
+
+
+# Exposition formats we can serve, in order of preference
+FORMATS = {
+    "protobuf": Format(
+        protobuf.MEDIA_TYPE, protobuf.CONTENT_TYPE_LATEST, protobuf.generate_latest
+    ),
+    "openmetrics": Format(
+        "application/openmetrics-text",
+        openmetrics.exposition.CONTENT_TYPE_LATEST,
+        openmetrics.exposition.generate_latest,
+        b"# EOF\n",
+    ),
+    "text": Format("text/plain", prom.CONTENT_TYPE_LATEST, prom.generate_latest),
+}
+
+
+def media_ranges(header: str):
+    """Yield the token, parameters and quality of each Accept-style header item."""
+    for item in header.split(","):
+        token, *params = (part.strip() for part in item.split(";"))
+        if not token:
+            continue
+        weight = 1.0
+        parameters = {}
+        for param in params:
+            name, _, value = param.partition("=")
+            name = name.strip().lower()
+            if name == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+            else:
+                parameters[name] = value.strip().strip('"')
+        yield token.lower(), parameters, weight
+
+
+def preferences(header: str) -> dict[str, float]:
+    """Map each token of an Accept-style header to its quality value."""
+    weights = {}
+    for token, _, weight in media_ranges(header):
+        weights[token] = max(weight, weights.get(token, 0.0))
+    return weights
+
+
+def quality(weights: dict[str, float], media_type: str) -> tuple[float, bool]:
+    """Quality of media_type by its most specific range, and whether it was
+    named rather than matched by a wildcard."""
+    major = media_type.split("/")[0]
+    for key in (media_type, f"{major}/*", "*/*"):
+        if key in weights:
+            return weights[key], key == media_type
+    return 0.0, False
+
+
+def negotiate_format(accept: str) -> str:
+    weights = preferences(accept)
+    # Only the delimited MetricFamily stream, and only when asked for by name
+    protobuf_weight = max(
+        (
+            weight
+            for token, params, weight in media_ranges(accept)
+            if token == protobuf.MEDIA_TYPE
+            and params.get("proto") == protobuf.PROTO
+            and params.get("encoding") == "delimited"
+        ),
+        default=None,
+    )
+    candidates = {
+        "protobuf": (protobuf_weight or 0.0, protobuf_weight is not None),
+        "openmetrics": quality(weights, FORMATS["openmetrics"].media_type),
+        "text": quality(weights, "text/plain"),
+    }
+    # Ties go to the format named, or to the classic text format if only
+    # wildcards matched; it is also the default
+    best = max(
+        candidates,
+        key=lambda name: (
+            *candidates[name],
+            name == "text" and not candidates[name][1],
+        ),
+    )
+    return best if candidates[best][0] > 0 else "text"
+
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    weights = preferences(accept_encoding)
+    candidates = {
+        encoding: weights.get(encoding, weights.get("*", 0.0))
+        for encoding in ENCODINGS
+        if encoding != "identity"
+    }
+    best = max(candidates, key=lambda name: candidates[name])
+    return best if candidates[best] > 0 else "identity"
+
+
+class Group:
+    """Just enough of a registry for the generate functions: given families."""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+class ExpositionCache:
+    """Render each endpoint group of a collection once per refresh.
+
+    The collection must provide groups(), mapping every group that collect()
+    yields, in order, to a version and its families; the families never change
+    under a version. A group is rendered and encoded again only when its own
+    version changes, so refreshing /system doesn't re-render the per-user
+    series, and the encoded groups are joined once per change to any of them.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        # (format, group) -> (version, bytes)
+        self._rendered = {}
+        # (format, encoding, group) -> (version, encoded part)
+        self._encoded = {}
+        # (format, encoding) -> (versions, joined prefix)
+        self._joined = {}
+        # Versions only mean something within this process
+        self._salt = os.urandom(8)
+        self._lock = asyncio.Lock()
+
+    def etag(self, fmt: str) -> str:
+        """ETag of the format's exposition of the current groups."""
+        return self._etag(fmt, self._versions(self.collection.groups()))
+
+    def _etag(self, fmt: str, versions: tuple) -> str:
+        digest = hashlib.blake2b(self._salt, digest_size=12)
+        digest.update(repr((fmt, versions)).encode())
+        # Weak, because every content encoding of a body shares it
+        return f'W/"{digest.hexdigest()}"'
+
+    @staticmethod
+    def _versions(groups: dict) -> tuple:
+        return tuple((name, version) for name, (version, _) in groups.items())
+
+    async def _cached(self, cache: dict, key, version, make, *args):
+        entry = cache.get(key)
+        if entry is None or entry[0] != version:
+            result = await asyncio.get_running_loop().run_in_executor(
+                api.executor, make, *args
+            )
+            entry = cache[key] = (version, result)
+        return entry[1]
+
+    @staticmethod
+    def _render(fmt: str, families) -> bytes:
+        body = FORMATS[fmt].generate(Group(families))
+        return body.removesuffix(FORMATS[fmt].trailer)
+
+    async def get(self, fmt: str, encoding: str) -> tuple:
+        """Return the encoding's prefix of the exposition of every group and
+        the ETag of that exposition."""
+        async with self._lock:
+            groups = self.collection.groups()
+            versions = self._versions(groups)
+            joined = self._joined.get((fmt, encoding))
+            if joined is not None and joined[0] == versions:
+                return joined[1], self._etag(fmt, versions)
+            datas, parts = [], []
+            for name, (version, families) in groups.items():
+                data = await self._cached(
+                    self._rendered, (fmt, name), version, self._render, fmt, families
+                )
+                datas.append(data)
+                parts.append(
+                    await self._cached(
+                        self._encoded,
+                        (fmt, encoding, name),
+                        version,
+                        ENCODINGS[encoding].part,
+                        data,
+                    )
+                )
+            prefix = await self._cached(
+                self._joined,
+                (fmt, encoding),
+                versions,
+                ENCODINGS[encoding].join,
+                datas,
+                parts,
+            )
+            return prefix, self._etag(fmt, versions)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header matches etag, by weak comparison."""
+    opaque = etag.removeprefix("W/")
+    for candidate in (if_none_match or "").split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque:
+            return True
+    return False
+
+
+async def render(
+    cache: ExpositionCache,
+    registry: prom.CollectorRegistry,
+    fmt: str,
+    encoding: str,
+) -> tuple[bytes, str]:
+    """Cached snapshot exposition followed by a fresh render of registry.
+
+    The registry holds the small, fast-changing exporter metrics, so only
+    those are rendered and compressed per scrape. They change on every
+    scrape, so the ETag covers only the Marzban metrics of the snapshot.
+    """
+    started = time.perf_counter()
+    prefix, snapshot_etag = await cache.get(fmt, encoding)
+    live = FORMATS[fmt].generate(registry)
+    body = ENCODINGS[encoding].finish(prefix, live)
+    instrumentation.render_duration.labels(fmt, encoding).observe(
+        time.perf_counter() - started
+    )
+    instrumentation.render_bytes.labels(fmt, encoding).observe(len(body))
+    return body, snapshot_etag
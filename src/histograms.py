@@ -0,0 +1,133 @@
+import math
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import Iterable, NamedTuple, Sequence
+
+import prometheus_client as prom
+from prometheus_client.utils import floatToGoString
+
+# Native histogram resolution: every power of two is split into 2**schema
+# exponential buckets (-4 to 8)
+NATIVE_HISTOGRAM_SCHEMA = int(os.getenv("NATIVE_HISTOGRAM_SCHEMA", "3"))
+# A native histogram with more buckets than this is coarsened a schema at a time
+NATIVE_HISTOGRAM_MAX_BUCKETS = int(os.getenv("NATIVE_HISTOGRAM_MAX_BUCKETS", "160"))
+# Observations at most this far from zero are counted in the zero bucket
+NATIVE_HISTOGRAM_ZERO_THRESHOLD = 2.0**-128
+
+
+class NativeHistogram(NamedTuple):
+    schema: int
+    zero_threshold: float
+    zero_count: int
+    # Bucket index -> observations, only for buckets that have any
+    positive: dict[int, int]
+    negative: dict[int, int]
+
+
+def parse_buckets(text: str) -> tuple[float, ...]:
+    """Sorted upper bounds from a comma-separated list, e.g. "0.5,1,2"."""
+    return tuple(sorted(float(bound) for bound in text.split(",") if bound.strip()))
+
+
+def series_key(labels: dict[str, str]) -> tuple:
+    """Identify a histogram series by its labels, regardless of their order."""
+    return tuple(sorted(labels.items()))
+
+
+def bucket_index(value: float, schema: int) -> int:
+    """Index i of the bucket (base**(i-1), base**i] with base 2**2**-schema."""
+    scale = 2.0**schema
+    index = math.ceil(math.log2(value) * scale)
+    # log2 may round across a bucket boundary
+    if 2.0 ** (index / scale) < value:
+        index += 1
+    elif 2.0 ** ((index - 1) / scale) >= value:
+        index -= 1
+    return index
+
+
+def _coarsen(buckets: Counter) -> Counter:
+    # Bucket i of a schema is half of bucket ceil(i / 2) of the one below
+    merged = Counter()
+    for index, count in buckets.items():
+        merged[-(-index // 2)] += count
+    return merged
+
+
+def _bucket_counts(magnitudes: Sequence[float], schema: int) -> Counter:
+    # One bisection per bucket between the smallest and largest magnitude,
+    # rather than a logarithm per value
+    buckets = Counter()
+    if not magnitudes:
+        return buckets
+    scale = 2.0**schema
+    below = 0
+    first = bucket_index(magnitudes[0], schema)
+    for index in range(first, bucket_index(magnitudes[-1], schema) + 1):
+        upto = bisect_right(magnitudes, 2.0 ** (index / scale), below)
+        if upto > below:
+            buckets[index] = upto - below
+        below = upto
+    return buckets
+
+
+def native_histogram(
+    values: Sequence[float],
+    schema: int = NATIVE_HISTOGRAM_SCHEMA,
+    max_buckets: int = NATIVE_HISTOGRAM_MAX_BUCKETS,
+) -> NativeHistogram:
+    """Native histogram of values, which must be sorted."""
+    zero_start = bisect_left(values, -NATIVE_HISTOGRAM_ZERO_THRESHOLD)
+    zero_end = bisect_right(values, NATIVE_HISTOGRAM_ZERO_THRESHOLD, zero_start)
+    positive = _bucket_counts(values[zero_end:], schema)
+    negative = _bucket_counts(
+        [-value for value in reversed(values[:zero_start])], schema
+    )
+    while len(positive) + len(negative) > max_buckets and schema > -4:
+        schema -= 1
+        positive, negative = _coarsen(positive), _coarsen(negative)
+    return NativeHistogram(
+        schema,
+        NATIVE_HISTOGRAM_ZERO_THRESHOLD,
+        zero_end - zero_start,
+        dict(positive),
+        dict(negative),
+    )
+
+
+class DistributionMetricFamily(prom.metrics_core.HistogramMetricFamily):
+    """A histogram of the values observed while building one snapshot.
+
+    Observations are only appended to a column until finish(), which sorts it
+    once and bisects it for every classic bucket. They are also kept as a
+    native histogram, which only the protobuf exposition can carry.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = (),
+        unit: str = "",
+    ):
+        super().__init__(name, documentation, unit=unit)
+        self.bounds = tuple(bound for bound in buckets if bound != math.inf)
+        self.native_histograms: dict[tuple, NativeHistogram] = {}
+        self._values = array("d")
+
+    def observe(self, values: Iterable[float]):
+        self._values.extend(values)
+
+    def finish(self):
+        """Turn the observations into samples, once all have been observed."""
+        values = sorted(self._values)
+        self._values = array("d")
+        buckets = [
+            (floatToGoString(bound), bisect_right(values, bound))
+            for bound in self.bounds
+        ]
+        buckets.append(("+Inf", len(values)))
+        self.add_metric([], buckets, math.fsum(values))
+        self.native_histograms[()] = native_histogram(values)
@@ -0,0 +1,75 @@
+import time
+
+import prometheus_client as prom
+
+# Metrics about the exporter itself, served on /metrics next to the Marzban ones
+registry = prom.CollectorRegistry()
+
+coalesced_requests = prom.Counter(
+    "marzban_exporter_coalesced_requests",
+    "Requests served by joining an identical call already in flight",
+    labelnames=["level"],
+    registry=registry,
+)
+
+upstream_latency = prom.Histogram(
+    "marzban_exporter_upstream_request_duration_seconds",
+    "Time until Marzban answered a request, by endpoint and HTTP status",
+    labelnames=["endpoint", "status"],
+    registry=registry,
+)
+
+upstream_bytes = prom.Histogram(
+    "marzban_exporter_upstream_response_bytes",
+    "Bytes received in the body of a Marzban response",
+    labelnames=["endpoint"],
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+    registry=registry,
+)
+
+decode_duration = prom.Histogram(
+    "marzban_exporter_decode_duration_seconds",
+    "Time spent decoding the JSON of a Marzban response",
+    labelnames=["endpoint"],
+    registry=registry,
+)
+
+collect_duration = prom.Histogram(
+    "marzban_exporter_collect_duration_seconds",
+    "Time spent building the samples of an endpoint from its decoded data",
+    labelnames=["endpoint"],
+    registry=registry,
+)
+
+collected_samples = prom.Histogram(
+    "marzban_exporter_collected_samples",
+    "Samples built by one refresh of an endpoint",
+    labelnames=["endpoint"],
+    buckets=(10, 100, 1e3, 1e4, 1e5, 1e6),
+    registry=registry,
+)
+
+render_duration = prom.Histogram(
+    "marzban_exporter_render_duration_seconds",
+    "Time spent rendering and encoding a /metrics response",
+    labelnames=["format", "encoding"],
+    registry=registry,
+)
+
+render_bytes = prom.Histogram(
+    "marzban_exporter_render_bytes",
+    "Size of a /metrics response body",
+    labelnames=["format", "encoding"],
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+    registry=registry,
+)
+
+
+def timed(call, *args):
+    """Call and return its result along with the seconds it took.
+
+    For work handed to the executor, so queueing time isn't counted.
+    """
+    started = time.perf_counter()
+    result = call(*args)
+    return result, time.perf_counter() - started
@@ -0,0 +1,293 @@
+"""A mock Marzban panel for exercising the exporter without a real one.
+
+Serves the endpoints the exporter scrapes with a synthetic fleet whose
+traffic grows over time, so counters and rates move between scrapes:
+
+    MOCK_USERS=100000 uvicorn mock_server:app --port 8001
+    MARZBAN_URL=http://127.0.0.1:8001 uvicorn exporter:app
+"""
+
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import msgspec
+from fastapi import FastAPI, Form, Request, Response
+
+# Size of the synthetic fleet
+MOCK_NODES = int(os.getenv("MOCK_NODES", "3"))
+MOCK_USERS = int(os.getenv("MOCK_USERS", "1000"))
+# Seed of the synthetic data, so runs are reproducible
+MOCK_SEED = int(os.getenv("MOCK_SEED", "1"))
+# Seconds every response is delayed by, plus up to MOCK_JITTER at random
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "0"))
+MOCK_JITTER = float(os.getenv("MOCK_JITTER", "0"))
+# Bytes of filler added to each user, like the proxies and links of a real panel
+MOCK_PAYLOAD_PADDING = int(os.getenv("MOCK_PAYLOAD_PADDING", "300"))
+# Fraction of requests answered with MOCK_ERROR_STATUS instead
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_ERROR_STATUS = int(os.getenv("MOCK_ERROR_STATUS", "500"))
+# Comma-separated API paths errors are injected into, e.g. "/users,/system";
+# all of them if unset
+MOCK_ERROR_ENDPOINTS = {
+    path.strip()
+    for path in os.getenv("MOCK_ERROR_ENDPOINTS", "").split(",")
+    if path.strip()
+}
+# Days of traffic the nodes have already recorded when the mock starts
+MOCK_HISTORY_DAYS = int(os.getenv("MOCK_HISTORY_DAYS", "90"))
+# Seconds an access token is valid for
+MOCK_TOKEN_TTL = int(os.getenv("MOCK_TOKEN_TTL", "86400"))
+# Credentials the panel accepts; any if unset
+MOCK_USERNAME = os.getenv("MOCK_USERNAME")
+MOCK_PASSWORD = os.getenv("MOCK_PASSWORD")
+
+app = FastAPI()
+started = time.time()
+rng = random.Random(MOCK_SEED)
+
+
+class Fleet:
+    """Synthetic nodes and users whose traffic keeps growing.
+
+    Node traffic is recorded in hourly rows like Marzban's node usage table,
+    at a speed that varies from hour to hour, so the sum over a trailing
+    window shrinks whenever an hour busier than the current one leaves it.
+    """
+
+    def __init__(self, nodes: int, users: int):
+        created = datetime.now(timezone.utc) - timedelta(days=365)
+        self.nodes = [
+            {
+                "id": index + 1,
+                "name": f"node-{index + 1}",
+                "address": f"10.0.{index // 250}.{index % 250 + 1}",
+                "port": 62050,
+                "api_port": 62051,
+                "usage_coefficient": 1.0,
+                "xray_version": "1.8.24",
+                "status": "connected",
+                "message": None,
+            }
+            for index in range(nodes)
+        ]
+        # Average bytes per second each node sends and receives
+        self.node_speeds = [
+            (rng.randint(10**5, 10**7), rng.randint(10**6, 10**8)) for _ in self.nodes
+        ]
+        self.first_hour = int(started // 3600) - MOCK_HISTORY_DAYS * 24
+        # Sums of the hourly speed factors of each node from first_hour on,
+        # extended as hours pass
+        self.factor_sums = [[0.0] for _ in self.nodes]
+        self.users = []
+        self.user_speeds = []
+        for index in range(users):
+            limited = rng.random() < 0.5
+            self.users.append(
+                {
+                    "username": f"user{index}",
+                    "status": "active",
+                    "used_traffic": 0,
+                    "lifetime_used_traffic": 0,
+                    "data_limit": (
+                        rng.choice((10, 50, 100)) * 2**30 if limited else None
+                    ),
+                    "data_limit_reset_strategy": "month" if limited else "no_reset",
+                    "expire": None,
+                    "created_at": (created + timedelta(minutes=index)).isoformat(),
+                    "note": "x" * MOCK_PAYLOAD_PADDING,
+                }
+            )
+            # Lifetime traffic so far, and bytes per second from now on
+            self.user_speeds.append(
+                (int(rng.paretovariate(1.2) * 10**8), rng.randint(0, 10**5))
+            )
+
+    def _factor(self, node: int, hour: int) -> float:
+        return 0.5 + zlib.crc32(f"{MOCK_SEED}:{node}:{hour}".encode()) % 1000 / 1000
+
+    def _seconds(self, node: int, since: float, now: float) -> float:
+        """Seconds at average speed the node has recorded since a time.
+
+        Like Marzban, only rows whose hour starts at or after it are summed.
+        """
+        hour = int(now // 3600)
+        first = max(math.ceil(since / 3600), self.first_hour)
+        if first > hour:
+            return 0.0
+        sums = self.factor_sums[node]
+        while len(sums) <= hour - self.first_hour:
+            sums.append(sums[-1] + self._factor(node, self.first_hour + len(sums) - 1))
+        whole = sums[hour - self.first_hour] - sums[first - self.first_hour]
+        return whole * 3600 + self._factor(node, hour) * (now - hour * 3600)
+
+    def node_usage(self, since: float) -> list[dict]:
+        now = time.time()
+        usages = []
+        for index, (node, (uplink, downlink)) in enumerate(
+            zip(self.nodes, self.node_speeds)
+        ):
+            seconds = self._seconds(index, since, now)
+            usages.append(
+                {
+                    "node_id": node["id"],
+                    "node_name": node["name"],
+                    "uplink": int(uplink * seconds),
+                    "downlink": int(downlink * seconds),
+                }
+            )
+        return usages
+
+    def user_page(self, offset: int, limit: int | None) -> list[dict]:
+        elapsed = time.time() - started
+        end = len(self.users) if limit is None else offset + limit
+        page = []
+        for user, (base, speed) in zip(
+            self.users[offset:end], self.user_speeds[offset:end]
+        ):
+            lifetime = base + int(speed * elapsed)
+            page.append(
+                {
+                    **user,
+                    "lifetime_used_traffic": lifetime,
+                    # A tenth of the lifetime traffic falls in the current period
+                    "used_traffic": lifetime // 10,
+                }
+            )
+        return page
+
+    def total_traffic(self) -> tuple[int, int]:
+        usages = self.node_usage(0)
+        return (
+            sum(usage["downlink"] for usage in usages),
+            sum(usage["uplink"] for usage in usages),
+        )
+
+
+fleet = Fleet(MOCK_NODES, MOCK_USERS)
+
+
+def _token() -> str:
+    def encode(part: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b"=").decode()
+
+    claims = {
+        "sub": "admin",
+        "access": "sudo",
+        "exp": int(time.time()) + MOCK_TOKEN_TTL,
+    }
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode(claims)}.mock"
+
+
+def _authorized(authorization: str) -> bool:
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer":
+        return False
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(
+            base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        )
+        return claims["exp"] > time.time()
+    except (IndexError, KeyError, ValueError):
+        return False
+
+
+def _json(data, status_code: int = 200) -> Response:
+    return Response(
+        msgspec.json.encode(data),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+@app.middleware("http")
+async def panel_behaviour(request: Request, call_next):
+    """Latency, error injection and authentication, in that order."""
+    path = request.url.path.removeprefix("/api")
+    if MOCK_LATENCY or MOCK_JITTER:
+        await asyncio.sleep(MOCK_LATENCY + rng.uniform(0, MOCK_JITTER))
+    if (
+        MOCK_ERROR_RATE
+        and (not MOCK_ERROR_ENDPOINTS or path in MOCK_ERROR_ENDPOINTS)
+        and rng.random() < MOCK_ERROR_RATE
+    ):
+        return _json({"detail": "Injected error"}, MOCK_ERROR_STATUS)
+    if path != "/admin/token" and not _authorized(
+        request.headers.get("Authorization", "")
+    ):
+        return _json({"detail": "Could not validate credentials"}, 401)
+    return await call_next(request)
+
+
+@app.post("/api/admin/token")
+async def token(username: str = Form(), password: str = Form()):
+    if (MOCK_USERNAME and username != MOCK_USERNAME) or (
+        MOCK_PASSWORD and password != MOCK_PASSWORD
+    ):
+        return _json({"detail": "Incorrect username or password"}, 401)
+    return _json({"access_token": _token(), "token_type": "bearer"})
+
+
+@app.get("/api/nodes")
+async def nodes():
+    return _json(fleet.nodes)
+
+
+@app.get("/api/nodes/usage")
+async def nodes_usage(start: str = ""):
+    # Like Marzban, usage over the last 30 days unless a start is given
+    if not start:
+        return _json({"usages": fleet.node_usage(time.time() - 30 * 86400)})
+    try:
+        since = datetime.fromisoformat(start)
+    except ValueError:
+        return _json({"detail": "Invalid date range or format"}, 400)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return _json({"usages": fleet.node_usage(since.timestamp())})
+
+
+@app.get("/api/system")
+async def system():
+    incoming, outgoing = fleet.total_traffic()
+    return _json(
+        {
+            "version": "0.8.4",
+            "mem_total": 8 * 2**30,
+            "mem_used": rng.randint(2 * 2**30, 6 * 2**30),
+            "cpu_cores": 4,
+            "cpu_usage": round(rng.uniform(5, 95), 1),
+            "total_user": len(fleet.users),
+            "users_active": len(fleet.users),
+            "incoming_bandwidth": incoming,
+            "outgoing_bandwidth": outgoing,
+            "incoming_bandwidth_speed": 0,
+            "outgoing_bandwidth_speed": 0,
+        }
+    )
+
+
+@app.get("/api/core")
+async def core():
+    return _json(
+        {"version": "1.8.24", "started": True, "logs_websocket": "/api/core/logs"}
+    )
+
+
+@app.get("/api/users")
+async def users(offset: int = 0, limit: int | None = None):
+    page = await asyncio.to_thread(fleet.user_page, offset, limit)
+    return _json({"users": page, "total": len(fleet.users)})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("MOCK_PORT", "8001")))
@@ -0,0 +1,58 @@
+import msgspec
+
+# Response models for the Marzban endpoints we scrape. They only declare the
+# fields the collector reads, so msgspec skips everything else while decoding
+# instead of building it and throwing it away. Structs are slotted.
+
+
+class Node(msgspec.Struct):
+    name: str = "unknown"
+    address: str | None = "unknown"
+    port: int | str | None = "unknown"
+    api_port: int | str | None = "unknown"
+    usage_coefficient: float = 0
+    xray_version: str | None = "unknown"
+    status: str | None = "unknown"
+
+
+class NodeUsage(msgspec.Struct):
+    node_name: str = "unknown"
+    uplink: int = 0
+    downlink: int = 0
+
+
+class NodesUsage(msgspec.Struct):
+    usages: list[NodeUsage] = []
+
+
+class System(msgspec.Struct):
+    mem_total: int = 0
+    mem_used: int = 0
+    cpu_usage: float = 0
+    total_user: int = 0
+    users_active: int = 0
+    incoming_bandwidth: int = 0
+    outgoing_bandwidth: int = 0
+
+
+class Core(msgspec.Struct):
+    started: bool = False
+
+
+class User(msgspec.Struct):
+    username: str = "unknown"
+    lifetime_used_traffic: int = 0
+    # Traffic of the current data limit period; no data_limit means unlimited
+    used_traffic: int = 0
+    data_limit: int | None = None
+
+
+class UsersPage(msgspec.Struct):
+    users: list[User] = []
+    total: int | None = None
+
+
+decoders = {
+    model: msgspec.json.Decoder(model)
+    for model in (list[Node], NodesUsage, System, Core, list[User], UsersPage)
+}
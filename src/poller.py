@@ -0,0 +1,49 @@
+import asyncio
+import os
+
+import api
+
+# Refresh endpoints in the background instead of on every scrape
+BACKGROUND_POLLING = os.getenv("BACKGROUND_POLLING", "false").lower() == "true"
+# Seconds between refreshes of each Marzban endpoint in background polling mode
+REFRESH_INTERVALS = {
+    "nodes": float(os.getenv("NODES_REFRESH_INTERVAL", "30")),
+    "nodes_usage": float(os.getenv("NODES_USAGE_REFRESH_INTERVAL", "15")),
+    "system": float(os.getenv("SYSTEM_REFRESH_INTERVAL", "5")),
+    "core": float(os.getenv("CORE_REFRESH_INTERVAL", "30")),
+    "users": float(os.getenv("USERS_REFRESH_INTERVAL", "120")),
+}
+
+
+class Poller:
+    """Refresh each endpoint of a collector on its own interval.
+
+    Scrapes then only read the latest snapshot, so upstream load no longer
+    depends on how many Prometheus servers scrape the exporter.
+    """
+
+    def __init__(self, collector: api.PrometheusCollector):
+        self.collector = collector
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._poll(endpoint, interval))
+            for endpoint, interval in REFRESH_INTERVALS.items()
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _poll(self, endpoint: str, interval: float):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            try:
+                await self.collector.refresh_endpoint(endpoint)
+            except Exception as e:
+                print(f"Error refreshing {endpoint}: {e}")
+            await asyncio.sleep(max(0, interval - (loop.time() - started)))
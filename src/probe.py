@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import time
+from typing import Iterable
+
+import prometheus_client as prom
+
+import api
+import catalog
+from histograms import series_key
+
+# JSON file mapping target names to panel credentials, e.g.
+# {"panel-1": {"url": "https://panel-1:8000", "username": "admin", "password": "..."}}
+TARGETS_FILE = os.getenv("TARGETS_FILE")
+# Serve every target on /metrics with a "panel" label instead of MARZBAN_URL
+FLEET_MODE = os.getenv("FLEET_MODE", "false").lower() == "true"
+# How many panels fleet mode refreshes at once
+FLEET_CONCURRENCY = int(os.getenv("FLEET_CONCURRENCY", "8"))
+# Seconds a single panel may take to refresh in fleet mode
+FLEET_PANEL_TIMEOUT = float(os.getenv("FLEET_PANEL_TIMEOUT", "8"))
+
+
+def load_targets(path: str | None = TARGETS_FILE) -> dict[str, dict]:
+    if not path:
+        return {}
+    with open(path) as file:
+        targets = json.load(file)
+    for name, target in targets.items():
+        missing = {"url", "username", "password"} - target.keys()
+        if missing:
+            raise Exception(f"Target {name} is missing {', '.join(sorted(missing))}")
+    return targets
+
+
+class TargetPool:
+    """Lazily created collectors for the configured Marzban panels.
+
+    Each target gets its own MarzbanAPI, so its connection pool, token and
+    cached snapshot are kept between probes and never shared with other panels.
+    """
+
+    def __init__(self, targets: dict[str, dict]):
+        self.targets = targets
+        self._collectors = {}
+
+    def get(self, name: str) -> api.PrometheusCollector | None:
+        if name not in self.targets:
+            return None
+        if name not in self._collectors:
+            target = self.targets[name]
+            self._collectors[name] = api.PrometheusCollector(
+                api.MarzbanAPI(target["url"], target["username"], target["password"])
+            )
+        return self._collectors[name]
+
+    def collectors(self) -> dict[str, api.PrometheusCollector]:
+        return {name: self.get(name) for name in self.targets}
+
+    async def close(self):
+        for collector in self._collectors.values():
+            await collector.api_client.close()
+        self._collectors = {}
+
+
+class ProbeCollector:
+    """Blackbox-style probe_success and probe_duration_seconds for one probe."""
+
+    def __init__(self, collector: api.PrometheusCollector, duration: float):
+        self.collector = collector
+        self.duration = duration
+
+    def collect(self):
+        success = prom.metrics_core.GaugeMetricFamily(
+            "probe_success", "Whether every endpoint of the panel was refreshed"
+        )
+        success.add_metric(
+            [], int(all(self.collector.up(endpoint) for endpoint in api.METRIC_GROUPS))
+        )
+        duration = prom.metrics_core.GaugeMetricFamily(
+            "probe_duration_seconds", "How long the probe took in seconds"
+        )
+        duration.add_metric([], self.duration)
+        yield success
+        yield duration
+
+
+def probe_registry(collector: api.PrometheusCollector, duration: float):
+    registry = prom.CollectorRegistry()
+    registry.register(collector)
+    registry.register(api.EndpointStatusCollector(collector))
+    registry.register(ProbeCollector(collector, duration))
+    return registry
+
+
+class FleetCollector:
+    """Serve every target of a pool as one exposition, labelled by panel.
+
+    Panels are refreshed concurrently, at most FLEET_CONCURRENCY at a time and
+    each within FLEET_PANEL_TIMEOUT, so a slow panel only loses its own fresh
+    data and never holds up the rest.
+    """
+
+    def __init__(self, pool: TargetPool):
+        self.pool = pool
+        self._semaphore = asyncio.Semaphore(FLEET_CONCURRENCY)
+
+    async def refresh(self, until: float | None = None):
+        refreshes = [
+            asyncio.create_task(self._refresh_panel(collector, until))
+            for collector in self.pool.collectors().values()
+        ]
+        if not refreshes:
+            return
+        _, pending = await asyncio.wait(
+            refreshes, timeout=None if until is None else until - time.monotonic()
+        )
+        for refresh in pending:
+            refresh.cancel()
+
+    async def _refresh_panel(self, collector: api.PrometheusCollector, until):
+        async with self._semaphore:
+            panel_until = time.monotonic() + FLEET_PANEL_TIMEOUT
+            if until is not None:
+                panel_until = min(panel_until, until)
+            await collector.refresh(panel_until)
+
+    def ready(self) -> bool:
+        # One unreachable panel shouldn't take the whole fleet out of rotation
+        return any(collector.ready() for collector in self.pool.collectors().values())
+
+    def groups(self) -> dict[str, tuple[tuple, Iterable]]:
+        """Each endpoint's refresh time on every panel, and its merged families.
+
+        The families are merged only when iterated, so a cached render of an
+        endpoint that no panel refreshed costs nothing.
+        """
+        panels = {
+            panel: collector.groups()
+            for panel, collector in self.pool.collectors().items()
+        }
+        groups = {}
+        for endpoint in api.METRIC_GROUPS:
+            refreshed = tuple(
+                (panel, panel_groups[endpoint][0])
+                for panel, panel_groups in panels.items()
+                if endpoint in panel_groups
+            )
+            if refreshed:
+                groups[endpoint] = (
+                    refreshed,
+                    merge_panels(
+                        (panel, panel_groups[endpoint][1])
+                        for panel, panel_groups in panels.items()
+                        if endpoint in panel_groups
+                    ),
+                )
+        return groups
+
+    def describe(self):
+        return catalog.describe()
+
+    def collect(self):
+        for _, families in self.groups().values():
+            yield from families
+
+
+class FleetStatusCollector:
+    """Endpoint freshness and health of every panel, labelled by panel."""
+
+    def __init__(self, pool: TargetPool):
+        self.pool = pool
+
+    def collect(self):
+        return merge_panels(
+            (panel, api.EndpointStatusCollector(collector).collect())
+            for panel, collector in self.pool.collectors().items()
+        )
+
+
+def merge_panels(panels: Iterable[tuple[str, Iterable]]):
+    """Merge the families of each (panel, families) pair into one per name."""
+    families = {}
+    for panel, panel_families in panels:
+        for family in panel_families:
+            merged = families.get(family.name)
+            if merged is None:
+                merged = families[family.name] = prom.metrics_core.Metric(
+                    family.name, family.documentation, family.type, family.unit
+                )
+                merged.native_histograms = {}
+            merged.samples.extend(
+                sample._replace(labels={**sample.labels, "panel": panel})
+                for sample in family.samples
+            )
+            for key, histogram in getattr(family, "native_histograms", {}).items():
+                labels = {**dict(key), "panel": panel}
+                merged.native_histograms[series_key(labels)] = histogram
+    yield from families.values()
@@ -0,0 +1,203 @@
+"""Prometheus protobuf exposition format.
+
+A stream of varint length-delimited io.prometheus.client.MetricFamily
+messages, encoded by hand with the field numbers of the client_model
+metrics.proto so no protobuf runtime is needed.
+"""
+
+import struct
+
+import prometheus_client as prom
+
+from histograms import NativeHistogram, series_key
+
+MEDIA_TYPE = "application/vnd.google.protobuf"
+PROTO = "io.prometheus.client.MetricFamily"
+CONTENT_TYPE_LATEST = f"{MEDIA_TYPE}; proto={PROTO}; encoding=delimited"
+
+# MetricType values, by prometheus_client family type
+COUNTER, GAUGE, SUMMARY, UNTYPED, HISTOGRAM, GAUGE_HISTOGRAM = range(6)
+TYPES = {
+    "counter": COUNTER,
+    "gauge": GAUGE,
+    "summary": SUMMARY,
+    "untyped": UNTYPED,
+    "unknown": UNTYPED,
+    "histogram": HISTOGRAM,
+    "gaugehistogram": GAUGE_HISTOGRAM,
+    "info": GAUGE,
+    "stateset": GAUGE,
+}
+# Protobuf families are named like their samples, suffix included
+NAME_SUFFIXES = {"counter": "_total", "info": "_info"}
+# Labels that tell apart the samples of one series rather than the series
+SAMPLE_LABELS = {
+    "histogram": ("le",),
+    "gaugehistogram": ("le",),
+    "summary": ("quantile",),
+}
+
+
+def _varint(n: int) -> bytes:
+    n &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _uint(field: int, n: int) -> bytes:
+    return _varint(field << 3) + _varint(int(n))
+
+
+def _sint(field: int, n: int) -> bytes:
+    return _uint(field, _zigzag(n))
+
+
+def _double(field: int, x: float) -> bytes:
+    return _varint(field << 3 | 1) + struct.pack("<d", x)
+
+
+def _bytes(field: int, data: bytes) -> bytes:
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+
+def _string(field: int, text: str) -> bytes:
+    return _bytes(field, text.encode())
+
+
+def _timestamp(field: int, seconds: float) -> bytes:
+    whole = int(seconds // 1)
+    return _bytes(field, _uint(1, whole) + _uint(2, round((seconds - whole) * 1e9)))
+
+
+def _spans(buckets: dict[int, int]) -> tuple[list, list]:
+    """BucketSpans and count deltas of the non-empty buckets of a native histogram."""
+    spans, deltas = [], []
+    previous_index = previous_count = 0
+    for index in sorted(buckets):
+        if spans and index == previous_index + 1:
+            spans[-1][1] += 1
+        else:
+            # The first span's offset is absolute, the others skip the gap
+            spans.append([index - previous_index - 1 if spans else index, 1])
+        deltas.append(buckets[index] - previous_count)
+        previous_index, previous_count = index, buckets[index]
+    return spans, deltas
+
+
+def _native(histogram: NativeHistogram) -> bytes:
+    fields = [
+        _sint(5, histogram.schema),
+        _double(6, histogram.zero_threshold),
+        _uint(7, histogram.zero_count),
+    ]
+    for span_field, delta_field, buckets in (
+        (9, 10, histogram.negative),
+        (12, 13, histogram.positive),
+    ):
+        spans, deltas = _spans(buckets)
+        fields.extend(
+            _bytes(span_field, _sint(1, offset) + _uint(2, length))
+            for offset, length in spans
+        )
+        if deltas:
+            packed = b"".join(_varint(_zigzag(delta)) for delta in deltas)
+            fields.append(_bytes(delta_field, packed))
+    return b"".join(fields)
+
+
+def _metric(family, key: tuple, samples: list) -> bytes:
+    fields = [_bytes(1, _string(1, name) + _string(2, value)) for name, value in key]
+    values, buckets, quantiles = {}, [], []
+    timestamp = None
+    for sample in samples:
+        if sample.timestamp is not None:
+            timestamp = float(sample.timestamp)
+        if "le" in sample.labels and family.type in ("histogram", "gaugehistogram"):
+            buckets.append((float(sample.labels["le"]), sample.value))
+        elif "quantile" in sample.labels and family.type == "summary":
+            quantiles.append((float(sample.labels["quantile"]), sample.value))
+        else:
+            values[sample.name[len(family.name) :]] = sample.value
+
+    kind = TYPES.get(family.type, UNTYPED)
+    if kind == COUNTER:
+        counter = _double(1, values.get("_total", 0.0))
+        if "_created" in values:
+            counter += _timestamp(3, values["_created"])
+        fields.append(_bytes(3, counter))
+    elif kind == SUMMARY:
+        summary = _uint(1, values.get("_count", 0)) + _double(2, values.get("_sum", 0))
+        summary += b"".join(
+            _bytes(3, _double(1, quantile) + _double(2, value))
+            for quantile, value in quantiles
+        )
+        if "_created" in values:
+            summary += _timestamp(4, values["_created"])
+        fields.append(_bytes(4, summary))
+    elif kind in (HISTOGRAM, GAUGE_HISTOGRAM):
+        count = values.get("_count", values.get("_gcount"))
+        if count is None:
+            count = buckets[-1][1] if buckets else 0
+        histogram = _uint(1, count) + _double(
+            2, values.get("_sum", values.get("_gsum", 0))
+        )
+        # +Inf is implied by the count
+        histogram += b"".join(
+            _bytes(3, _uint(1, cumulative) + _double(2, bound))
+            for bound, cumulative in buckets
+            if bound != float("inf")
+        )
+        native = getattr(family, "native_histograms", {}).get(key)
+        if native is not None:
+            histogram += _native(native)
+        if "_created" in values:
+            histogram += _timestamp(15, values["_created"])
+        fields.append(_bytes(7, histogram))
+    else:
+        value = next(iter(values.values()), 0.0)
+        fields.append(_bytes(2 if kind == GAUGE else 5, _double(1, value)))
+    if timestamp is not None:
+        fields.append(_uint(6, round(timestamp * 1000)))
+    return b"".join(fields)
+
+
+def _family(family) -> bytes:
+    series = {}
+    sample_labels = SAMPLE_LABELS.get(family.type, ())
+    for sample in family.samples:
+        labels = {
+            name: value
+            for name, value in sample.labels.items()
+            if name not in sample_labels
+        }
+        series.setdefault(series_key(labels), []).append(sample)
+    fields = [
+        _string(1, family.name + NAME_SUFFIXES.get(family.type, "")),
+        _string(2, family.documentation),
+        _uint(3, TYPES.get(family.type, UNTYPED)),
+    ]
+    fields.extend(
+        _bytes(4, _metric(family, key, samples)) for key, samples in series.items()
+    )
+    if family.unit:
+        fields.append(_string(5, family.unit))
+    return b"".join(fields)
+
+
+def generate_latest(registry: prom.CollectorRegistry = prom.REGISTRY) -> bytes:
+    messages = []
+    for family in registry.collect():
+        # Like client_golang, leave out families without metrics
+        if not family.samples:
+            continue
+        message = _family(family)
+        messages.append(_varint(len(message)) + message)
+    return b"".join(messages)
@@ -0,0 +1,109 @@
+import os
+import re
+import time
+from collections import deque
+from typing import Sequence
+
+import prometheus_client as prom
+
+
+def parse_duration(text: str) -> float:
+    """Seconds in a duration like "90s", "5m" or "1h"."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smh]?)", text.strip())
+    if match is None:
+        raise Exception(f"Invalid duration {text}")
+    number, unit = match.groups()
+    return float(number) * {"": 1, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+# Windows of the bytes/sec gauges, also used as their "window" label
+RATE_WINDOWS = {
+    window.strip(): parse_duration(window)
+    for window in os.getenv("RATE_WINDOWS", "1m,5m").split(",")
+    if window.strip()
+}
+# Readings kept per series; should cover the longest window at the refresh
+# interval of /nodes/usage and /system, or the rates span less than it
+RATE_BUFFER_SIZE = int(os.getenv("RATE_BUFFER_SIZE", "128"))
+
+
+class RateBuffer:
+    """Recent readings of one cumulative total in a fixed-size ring buffer.
+
+    Each window keeps the absolute index of its oldest reading and only moves
+    it forward as readings arrive, so rates are kept up to date in amortized
+    constant time per reading instead of rescanning the buffer.
+    """
+
+    def __init__(self, size: int = RATE_BUFFER_SIZE):
+        self.readings = deque(maxlen=size)
+        self.dropped = 0
+        self.starts = dict.fromkeys(RATE_WINDOWS, 0)
+        self._last = None
+        self._offset = 0
+
+    def add(self, when: float, value: float):
+        # A lower total is a reset; keep the buffered totals monotonic
+        if self._last is not None and value < self._last:
+            self._offset += self._last
+        self._last = value
+        if len(self.readings) == self.readings.maxlen:
+            self.dropped += 1
+        self.readings.append((when, value + self._offset))
+        for window, seconds in RATE_WINDOWS.items():
+            # The oldest reading kept is the newest one at or before the
+            # window's start, so the window is covered in full
+            start = max(self.starts[window], self.dropped)
+            while (
+                start + 1 - self.dropped < len(self.readings)
+                and self.readings[start + 1 - self.dropped][0] <= when - seconds
+            ):
+                start += 1
+            self.starts[window] = start
+
+    def rate(self, window: str) -> float | None:
+        first_time, first_value = self.readings[self.starts[window] - self.dropped]
+        last_time, last_value = self.readings[-1]
+        if last_time <= first_time:
+            return None
+        return (last_value - first_value) / (last_time - first_time)
+
+
+class RateState:
+    """Ring buffer of each series of a rate, carried from one refresh to the next."""
+
+    def __init__(self):
+        self.series: dict[tuple, RateBuffer] = {}
+
+
+class RateMetricFamily(prom.metrics_core.GaugeMetricFamily):
+    """Per-second increase of a cumulative total over each of RATE_WINDOWS.
+
+    Each refresh adds a reading to the series' ring buffer; a series needs two
+    readings before it has a rate. commit() forgets the series this refresh
+    didn't see.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str],
+        state: RateState,
+    ):
+        super().__init__(name, documentation, labels=[*labels, "window"])
+        self.state = state
+        self.series = {}
+
+    def add_reading(self, labels: Sequence[str], value: float):
+        key = tuple(labels)
+        buffer = self.state.series.get(key) or RateBuffer()
+        buffer.add(time.monotonic(), value)
+        self.series[key] = buffer
+        for window in RATE_WINDOWS:
+            rate = buffer.rate(window)
+            if rate is not None:
+                self.add_metric([*labels, window], rate)
+
+    def commit(self):
+        self.state.series = self.series
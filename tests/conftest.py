@@ -0,0 +1,100 @@
+import asyncio
+import base64
+import json
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+import pytest
+
+# The exporter's modules import each other as top-level modules from src/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import api  # noqa: E402
+
+
+def jwt(expires_in: float = 3600, token_id: int = 0) -> str:
+    claims = json.dumps(
+        {"sub": "admin", "exp": int(time.time() + expires_in), "jti": token_id}
+    )
+    payload = base64.urlsafe_b64encode(claims.encode()).rstrip(b"=").decode()
+    return f"header.{payload}.signature"
+
+
+class FakePanel:
+    """A Marzban panel served in-process through httpx.MockTransport.
+
+    Set delays[path] to an asyncio.Event to hold that endpoint's responses
+    until the event is set; requested[path] is set once a request arrives,
+    counts[path] counts them, and params[path] holds the query parameters of
+    the latest one. Every login issues a new token valid for token_lifetime
+    seconds, and tokens in revoked get a 401.
+    """
+
+    def __init__(self, users: int = 3):
+        self.users = users
+        self.delays: dict[str, asyncio.Event] = {}
+        self.requested: dict[str, asyncio.Event] = {}
+        self.statuses: dict[str, int] = {}
+        self.params: dict[str, dict] = {}
+        self.counts = Counter()
+        self.logins = 0
+        self.token_lifetime = 3600
+        self.revoked: set[str] = set()
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/api")
+        self.requested.setdefault(path, asyncio.Event()).set()
+        self.counts[path] += 1
+        self.params[path] = dict(request.url.params)
+        if path in self.delays:
+            await self.delays[path].wait()
+        if path in self.statuses:
+            return httpx.Response(self.statuses[path])
+        if path == "/admin/token":
+            self.logins += 1
+            token = jwt(self.token_lifetime, self.logins)
+            return httpx.Response(200, json={"access_token": token})
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if token in self.revoked:
+            return httpx.Response(401)
+        return httpx.Response(200, json=self.body(path, request.url.params))
+
+    def body(self, path: str, params):
+        if path == "/nodes":
+            return [{"name": "node-1", "usage_coefficient": 1.0}]
+        if path == "/nodes/usage":
+            return {"usages": [{"node_name": "node-1", "uplink": 10, "downlink": 20}]}
+        if path == "/system":
+            return {"mem_total": 100, "total_user": self.users}
+        if path == "/core":
+            return {"started": True}
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", self.users))
+        return {
+            "users": [
+                {"username": f"user{index}", "lifetime_used_traffic": index}
+                for index in range(offset, min(offset + limit, self.users))
+            ],
+            "total": self.users,
+        }
+
+    def client(self) -> api.MarzbanAPI:
+        client = api.MarzbanAPI("http://panel", "admin", "secret")
+        client.client = httpx.AsyncClient(
+            base_url="http://panel/api", transport=httpx.MockTransport(self.handler)
+        )
+        client.tokens.client = client.client
+        return client
+
+
+@pytest.fixture
+def panel() -> FakePanel:
+    return FakePanel()
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
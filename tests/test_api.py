@@ -0,0 +1,291 @@
+import asyncio
+import json
+import random
+import time
+
+import pytest
+
+import api
+import instrumentation
+from conftest import FakePanel
+from models import UsersPage, decoders
+
+
+@pytest.mark.anyio
+async def test_breaker_trial_cut_short_by_deadline_allows_another(panel, monkeypatch):
+    monkeypatch.setattr(api, "BREAKER_RESET_TIMEOUT", 0)
+    client = panel.client()
+    breaker = client._breakers["/nodes"]
+
+    panel.statuses["/nodes"] = 500
+    for _ in range(api.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(Exception, match="500"):
+            await client._send("/nodes")
+    assert breaker.opened_at is not None
+
+    # The trial gets a 401 after its deadline, so logging in again runs out
+    # of budget before the endpoint succeeds or fails
+    panel.statuses["/nodes"] = 401
+    release = panel.delays["/nodes"] = asyncio.Event()
+    asyncio.get_running_loop().call_later(0.1, release.set)
+    token = api.deadline.set(time.monotonic() + 0.05)
+    try:
+        with pytest.raises(api.DeadlineExceeded):
+            await client._send("/nodes")
+    finally:
+        api.deadline.reset(token)
+
+    assert breaker.allow()
+    breaker.release()
+
+    del panel.statuses["/nodes"]
+    await client._send("/nodes")
+    assert breaker.opened_at is None
+    await client.close()
+
+
+@pytest.mark.anyio
+async def test_nodes_usage_is_requested_since_a_fixed_start(panel):
+    client = panel.client()
+    await client.fetch_nodes_usage_data()
+    # Marzban's default is a trailing 30 days, which isn't a cumulative total
+    assert panel.params["/nodes/usage"] == {"start": api.NODES_USAGE_START}
+    await client.close()
+
+
+def users_body(pretty: bool) -> bytes:
+    users = [
+        {
+            "username": f"user{index}-ü€😀",
+            "proxies": {"vless": {"id": "a", "flow": ""}, "trojan": {}},
+            "inbounds": {"vless": ["in-1", "in-2"]},
+            # Brackets and quotes inside strings must not end a user
+            "note": 'ends "},{" or "}]" \\"} [{',
+            "links": [f"vless://{index}}},{{"],
+            "lifetime_used_traffic": index * 1000,
+            "used_traffic": index,
+            "data_limit": None if index % 2 else 10**9,
+            "admin": {"username": "root", "is_sudo": True},
+        }
+        for index in range(50)
+    ]
+    body = {"total": 50, "users": users, "extra": [{"nested": {"deep": [1.5e3]}}]}
+    return json.dumps(body, indent=2 if pretty else None).encode()
+
+
+@pytest.mark.parametrize("pretty", [False, True])
+def test_users_stream_decoder_handles_any_chunking(pretty):
+    body = users_body(pretty)
+    expected = decoders[UsersPage].decode(body)
+    rng = random.Random(5)
+    for _ in range(50):
+        cuts = sorted(rng.sample(range(1, len(body)), rng.randrange(1, 40)))
+        decoder = api.UsersStreamDecoder()
+        users = []
+        for start, end in zip([0, *cuts], [*cuts, len(body)]):
+            users += decoder.feed(body[start:end])
+        users += decoder.close()
+        assert users == expected.users
+        assert decoder.total == 50
+
+
+def test_users_stream_decoder_byte_by_byte():
+    body = users_body(False)
+    decoder = api.UsersStreamDecoder()
+    users = []
+    for index in range(len(body)):
+        users += decoder.feed(body[index : index + 1])
+    users += decoder.close()
+    assert users == decoders[UsersPage].decode(body).users
+
+
+@pytest.mark.parametrize(
+    "body, error",
+    [
+        (b'{"users": [{"username": "a"}, {"username": "b"', "malformed|truncated"),
+        (b'{"users": [{"username": "a"}], "total": 1', "truncated"),
+        (b'{"users": [{"username": 5}]}', "Unexpected response"),
+        (b'{"users": {"username": "a"}}', "expected a list"),
+        (b"[]", "expected an object"),
+    ],
+)
+def test_users_stream_decoder_rejects_bad_bodies(body, error):
+    decoder = api.UsersStreamDecoder()
+    with pytest.raises(Exception, match=error):
+        decoder.feed(body)
+        decoder.close()
+
+
+class OverlappingPanel(FakePanel):
+    """A panel whose pages after the first start one user early, as happens
+    when users tie on the sort key or one is added to an earlier page."""
+
+    def body(self, path: str, params):
+        if path == "/users" and int(params.get("offset", 0)) > 0:
+            params = {**params, "offset": int(params["offset"]) - 1}
+        return super().body(path, params)
+
+
+@pytest.mark.anyio
+async def test_users_pages_are_sorted_and_skip_users_seen(monkeypatch):
+    monkeypatch.setattr(api, "USERS_PAGE_SIZE", 2)
+    panel = OverlappingPanel(users=6)
+    client = panel.client()
+    pages = [page.users async for page in client.iter_users_pages()]
+    usernames = [user.username for users in pages for user in users]
+    assert usernames == [f"user{index}" for index in range(5)]
+    assert panel.params["/users"]["sort"] == "created_at"
+    await client.close()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "lifetime, logins",
+    [
+        (3600, 1),
+        # Expires within TOKEN_REFRESH_MARGIN, so each request logs in first
+        (api.TOKEN_REFRESH_MARGIN - 10, 3),
+    ],
+)
+async def test_token_is_renewed_ahead_of_expiry(panel, lifetime, logins):
+    panel.token_lifetime = lifetime
+    client = panel.client()
+    for _ in range(3):
+        await client._send("/system")
+    assert panel.logins == logins
+    await client.close()
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_share_one_login(panel):
+    client = panel.client()
+    release = panel.delays["/admin/token"] = asyncio.Event()
+    requested = panel.requested["/admin/token"] = asyncio.Event()
+    requests = [
+        asyncio.create_task(client._send(endpoint))
+        for endpoint in ("/nodes", "/system", "/core") * 4
+    ]
+    await asyncio.wait_for(requested.wait(), timeout=5)
+    await asyncio.sleep(0.01)
+    release.set()
+    await asyncio.gather(*requests)
+    assert panel.logins == 1
+    await client.close()
+
+
+@pytest.mark.anyio
+async def test_rejected_token_logs_in_once_and_retries(panel):
+    client = panel.client()
+    await client._send("/system")
+    panel.revoked.add(client.tokens.token)
+
+    # Both get a 401, but only the first replaces the token
+    responses = await asyncio.gather(client._send("/system"), client._send("/core"))
+    assert [response.status_code for response in responses] == [200, 200]
+    assert panel.logins == 2
+
+    # A 401 right after logging in again is an error, not another login
+    panel.statuses["/system"] = 401
+    with pytest.raises(Exception, match="401"):
+        await client._send("/system")
+    assert panel.logins == 3
+    await client.close()
+
+
+@pytest.mark.anyio
+async def test_stale_metrics_are_served_within_stale_if_error(panel, monkeypatch):
+    collection = api.PrometheusCollector(panel.client())
+    await collection.refresh()
+    refreshed = collection.groups()["system"][0]
+
+    panel.statuses["/system"] = 500
+    await collection.refresh()
+    assert not collection.up("system")
+    assert collection.groups()["system"][0] == refreshed
+    assert "system_memory_total_bytes" in {
+        family.name for family in collection.collect()
+    }
+
+    # Past CACHE_STALE_IF_ERROR the failing endpoint is dropped, the rest stay
+    monkeypatch.setattr(api, "CACHE_STALE_IF_ERROR", 0)
+    assert list(collection.groups()) == ["nodes", "nodes_usage", "core", "users"]
+    await collection.api_client.close()
+
+
+@pytest.mark.anyio
+async def test_stale_while_revalidate_refreshes_in_background(panel, monkeypatch):
+    monkeypatch.setattr(api, "CACHE_STALE_WHILE_REVALIDATE", 3600)
+    collection = api.PrometheusCollector(panel.client())
+    await collection.refresh()
+    refreshed = collection.groups()["system"][0]
+
+    release = panel.delays["/system"] = asyncio.Event()
+    requested = panel.requested["/system"] = asyncio.Event()
+    # Answered from cache right away, while /system is still being fetched
+    await asyncio.wait_for(collection.refresh(), timeout=1)
+    await asyncio.wait_for(requested.wait(), timeout=1)
+    assert collection.groups()["system"][0] == refreshed
+
+    release.set()
+    while collection.groups()["system"][0] == refreshed:
+        await asyncio.sleep(0.01)
+    await collection.api_client.close()
+
+
+@pytest.mark.anyio
+async def test_breaker_opens_after_threshold_and_fails_fast(panel, monkeypatch):
+    client = panel.client()
+    panel.statuses["/nodes"] = 500
+    for _ in range(api.BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(Exception, match="500"):
+            await client._send("/nodes")
+    assert panel.counts["/nodes"] == api.BREAKER_FAILURE_THRESHOLD
+
+    with pytest.raises(api.CircuitOpenError):
+        await client._send("/nodes")
+    assert panel.counts["/nodes"] == api.BREAKER_FAILURE_THRESHOLD
+    # Other endpoints have breakers of their own
+    await client._send("/system")
+
+    # After BREAKER_RESET_TIMEOUT one trial goes through, and its success closes it
+    monkeypatch.setattr(api, "BREAKER_RESET_TIMEOUT", 0)
+    del panel.statuses["/nodes"]
+    await client._send("/nodes")
+    await client._send("/nodes")
+    assert panel.counts["/nodes"] == api.BREAKER_FAILURE_THRESHOLD + 2
+    await client.close()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("page_size", [0, 2])
+async def test_self_monitoring_labels_endpoints_by_group(panel, monkeypatch, page_size):
+    monkeypatch.setattr(api, "USERS_PAGE_SIZE", page_size)
+    collection = api.PrometheusCollector(panel.client())
+    await collection.refresh()
+    await collection.api_client.close()
+
+    def endpoints(name: str) -> set[str]:
+        return {
+            sample.labels["endpoint"]
+            for family in instrumentation.registry.collect()
+            if family.name == name
+            for sample in family.samples
+        }
+
+    groups = set(api.METRIC_GROUPS)
+    assert endpoints("marzban_exporter_upstream_request_duration_seconds") == {
+        *groups,
+        "admin_token",
+    }
+    for name in (
+        "marzban_exporter_upstream_response_bytes",
+        "marzban_exporter_decode_duration_seconds",
+        "marzban_exporter_collect_duration_seconds",
+        "marzban_exporter_collected_samples",
+    ):
+        assert endpoints(name) == groups
+    assert {
+        sample.labels["endpoint"]
+        for family in api.EndpointStatusCollector(collection).collect()
+        for sample in family.samples
+    } == groups
@@ -0,0 +1,95 @@
+import zlib
+
+import prometheus_client as prom
+import pytest
+
+import cardinality
+from cardinality import UserSeries
+from counters import CounterState, CumulativeMetricFamily
+from models import User
+
+
+def refresh(state: CounterState, mode: str, traffic: dict[str, int]):
+    """Run one refresh over two pages; return its per-user and per-shard samples."""
+    per_user = CumulativeMetricFamily("user_traffic_bytes", "", ["username"], state)
+    per_shard = prom.metrics_core.GaugeMetricFamily(
+        "shard_traffic_bytes", "", labels=["shard"]
+    )
+    series = UserSeries(per_user, per_shard, mode)
+    users = [User(name, total) for name, total in traffic.items()]
+    series.observe(users[: len(users) // 2])
+    series.observe(users[len(users) // 2 :])
+    series.finish()
+    per_user.commit()
+    return (
+        [
+            (sample.labels["username"], sample.value)
+            for sample in per_user.samples
+            if sample.name == "user_traffic_bytes_total"
+        ],
+        {sample.labels["shard"]: sample.value for sample in per_shard.samples},
+    )
+
+
+TRAFFIC = {"alice": 300, "bob": 100, "carol": 500, "dave": 200, "erin": 400}
+
+
+def test_all_exports_every_user():
+    users, shards = refresh(CounterState(), "all", TRAFFIC)
+    assert users == list(TRAFFIC.items())
+    assert shards == {}
+
+
+def test_none_exports_and_tracks_nothing():
+    state = CounterState()
+    assert refresh(state, "none", TRAFFIC) == ([], {})
+    assert state.series == {}
+
+
+def test_top_keeps_the_k_users_with_most_traffic(monkeypatch):
+    monkeypatch.setattr(cardinality, "USER_SERIES_TOP_K", 2)
+    users, _ = refresh(CounterState(), "top", TRAFFIC)
+    assert users == [("carol", 500), ("erin", 400)]
+
+
+def test_user_entering_top_k_keeps_its_counter(monkeypatch):
+    monkeypatch.setattr(cardinality, "USER_SERIES_TOP_K", 2)
+    state = CounterState()
+    refresh(state, "top", TRAFFIC)
+    # bob was tracked outside the top K, including a reset there
+    refresh(state, "top", {**TRAFFIC, "bob": 50})
+    users, _ = refresh(state, "top", {**TRAFFIC, "bob": 1000})
+    assert users == [("bob", 1100), ("carol", 500)]
+    # Known since the first refresh, so no creation time to restart it at
+    assert state.series[("bob",)][2] is None
+
+
+def test_shards_sum_the_traffic_of_their_users(monkeypatch):
+    monkeypatch.setattr(cardinality, "USER_SERIES_SHARDS", 4)
+    users, shards = refresh(CounterState(), "shards", TRAFFIC)
+    expected = {str(shard): 0 for shard in range(4)}
+    for name, total in TRAFFIC.items():
+        expected[str(zlib.crc32(name.encode()) % 4)] += total
+    assert users == []
+    assert shards == expected
+    assert sum(shards.values()) == sum(TRAFFIC.values())
+
+
+@pytest.mark.parametrize(
+    "allow, deny, expected",
+    [
+        ("a.*|b.*", None, ["alice", "bob"]),
+        (None, "carol|dave", ["alice", "bob", "erin"]),
+        # The deny list wins, and both must match the whole username
+        (".*e.*", "alice", ["dave", "erin"]),
+        ("ali", None, []),
+    ],
+)
+def test_allow_and_deny_filter_users(monkeypatch, allow, deny, expected):
+    monkeypatch.setattr(cardinality, "USER_SERIES_ALLOW", allow)
+    monkeypatch.setattr(cardinality, "USER_SERIES_DENY", deny)
+    state = CounterState()
+    users, _ = refresh(state, "all", TRAFFIC)
+    assert [name for name, _ in users] == expected
+    # Filtered users aren't tracked either
+    assert sorted(key[0] for key in state.series) == sorted(expected)
@@ -0,0 +1,79 @@
+import prometheus_client as prom
+
+from counters import CounterState, CumulativeMetricFamily
+
+
+def refresh(state: CounterState, totals: dict[str, float]) -> CumulativeMetricFamily:
+    family = CumulativeMetricFamily("traffic_bytes", "Traffic", ["user"], state)
+    for user, total in totals.items():
+        family.add_total([user], total)
+    family.commit()
+    return family
+
+
+class Families:
+    def __init__(self, *families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def test_only_series_seen_to_start_are_created():
+    state = CounterState()
+    first = refresh(state, {"old": 5000})
+    assert [sample.name for sample in first.samples] == ["traffic_bytes_total"]
+
+    second = refresh(state, {"old": 6000, "new": 10})
+    created = {
+        sample.labels["user"]: sample.value
+        for sample in second.samples
+        if sample.name == "traffic_bytes_created"
+    }
+    assert created == {"new": second.now}
+
+    # In the text format a creation time is a series of its own
+    text = prom.generate_latest(Families(second)).decode()
+    assert 'traffic_bytes_created{user="new"}' in text
+    assert 'traffic_bytes_created{user="old"}' not in text
+
+
+def test_creation_time_is_kept_across_refreshes():
+    state = CounterState()
+    refresh(state, {})
+    second = refresh(state, {"new": 10})
+    third = refresh(state, {"new": 20})
+    assert third.total(["new"], 20) == (20, second.now)
+
+
+def test_resets_carry_the_previous_total_as_an_offset():
+    state = CounterState()
+    exposed = []
+    for total in (5000, 100, 300, 50, 60):
+        family = refresh(state, {"alice": total})
+        exposed.append(family.samples[0].value)
+    assert exposed == [5000, 5100, 5300, 5350, 5360]
+
+
+def test_commit_forgets_series_not_seen():
+    state = CounterState()
+    refresh(state, {"alice": 5000, "bob": 10})
+    refresh(state, {"alice": 100})
+    assert list(state.series) == [("alice",)]
+    # bob comes back as a new series, without the offset or total it had
+    family = refresh(state, {"alice": 200, "bob": 5})
+    values = {
+        sample.labels["user"]: sample.value
+        for sample in family.samples
+        if sample.name == "traffic_bytes_total"
+    }
+    assert values == {"alice": 5200, "bob": 5}
+
+
+def test_uncommitted_refresh_leaves_the_state_alone():
+    state = CounterState()
+    refresh(state, {"alice": 5000})
+    family = CumulativeMetricFamily("traffic_bytes", "Traffic", ["user"], state)
+    family.add_total(["alice"], 100)
+    # A refresh that fails before commit() must not count as a reset
+    assert refresh(state, {"alice": 6000}).samples[0].value == 6000
@@ -0,0 +1,68 @@
+import asyncio
+import cProfile
+import sys
+
+import pytest
+
+import api
+import debug
+import instrumentation
+
+
+def busy_work() -> int:
+    return sum(index * index for index in range(20000))
+
+
+async def scrape_during(capture: asyncio.Task):
+    # Stands in for the refreshes that scrapes run while a capture lasts
+    while not capture.done():
+        _, seconds = await asyncio.get_running_loop().run_in_executor(
+            api.executor, instrumentation.timed, busy_work
+        )
+        instrumentation.collect_duration.labels("system").observe(seconds)
+        await asyncio.sleep(0.01)
+
+
+async def assert_no_profiler_left():
+    # Enabling one fails on 3.12+ while another is active; before that each
+    # thread has its own, so check the event loop thread and every worker
+    profiler = cProfile.Profile()
+    profiler.enable()
+    profiler.disable()
+    assert sys.getprofile() is None
+    assert await debug._on_each_worker(sys.getprofile) == [None] * api.EXPORTER_WORKERS
+
+
+@pytest.mark.anyio
+async def test_profile_covers_workers_and_can_run_again():
+    for _ in range(2):
+        capture = asyncio.create_task(debug.profile(0.2, 50))
+        await scrape_during(capture)
+        output = capture.result()
+        assert "busy_work" in output
+        assert not output.startswith("0 endpoint refreshes")
+        await assert_no_profiler_left()
+
+
+@pytest.mark.anyio
+async def test_capture_runs_no_cycles_of_its_own():
+    before = debug._refreshes()
+    output = await debug.heap(0.1, 10)
+    assert debug._refreshes() == before
+    assert output.startswith("0 endpoint refreshes in 0.1s")
+
+
+@pytest.mark.anyio
+async def test_profile_stops_started_profilers_when_cancelled():
+    capture = asyncio.create_task(debug.profile(5, 50))
+    await asyncio.sleep(0.1)
+    capture.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await capture
+    # The shielded stop finishes in the background
+    while debug.capturing.locked():
+        await asyncio.sleep(0.01)
+    await assert_no_profiler_left()
+    capture = asyncio.create_task(debug.profile(0.2, 50))
+    await scrape_during(capture)
+    assert "busy_work" in capture.result()
@@ -0,0 +1,100 @@
+import asyncio
+
+import httpx
+import pytest
+
+import api
+import exporter
+import exposition
+import probe
+
+
+@pytest.fixture
+async def exporter_client(panel):
+    collection = api.PrometheusCollector(panel.client())
+    exporter.app.state.collection = collection
+    exporter.app.state.snapshot_cache = exposition.ExpositionCache(collection)
+    transport = httpx.ASGITransport(app=exporter.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://exporter"
+    ) as client:
+        yield client
+    await collection.api_client.close()
+
+
+@pytest.mark.anyio
+async def test_requests_are_served_during_slow_upstream_fetch(panel, exporter_client):
+    release = panel.delays["/users"] = asyncio.Event()
+    requested = panel.requested["/users"] = asyncio.Event()
+
+    scrape = asyncio.create_task(exporter_client.get("/metrics"))
+    await asyncio.wait_for(requested.wait(), timeout=5)
+
+    # /metrics is stuck on /users, yet the event loop keeps serving others
+    health = await asyncio.wait_for(exporter_client.get("/healthz"), timeout=1)
+    assert health.status_code == 200
+    assert not scrape.done()
+
+    release.set()
+    response = await asyncio.wait_for(scrape, timeout=5)
+    assert response.status_code == 200
+    assert "total_users 3.0" in response.text
+
+
+@pytest.mark.anyio
+async def test_unchanged_snapshot_is_not_modified(exporter_client, monkeypatch):
+    monkeypatch.setattr(api, "CACHE_MAX_AGE", 3600)
+    first = await exporter_client.get("/metrics")
+    assert first.status_code == 200
+
+    second = await exporter_client.get(
+        "/metrics", headers={"If-None-Match": first.headers["ETag"]}
+    )
+    assert second.status_code == 304
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "if_none_match",
+    ['"other", {etag}', '{etag},W/"other"', "{opaque}", "*"],
+)
+async def test_not_modified_is_answered_before_rendering(
+    exporter_client, monkeypatch, if_none_match
+):
+    monkeypatch.setattr(api, "CACHE_MAX_AGE", 3600)
+    etag = (await exporter_client.get("/metrics")).headers["ETag"]
+
+    async def render(*args):
+        raise AssertionError("A 304 shouldn't render the exposition")
+
+    monkeypatch.setattr(exposition, "render", render)
+    header = if_none_match.format(etag=etag, opaque=etag.removeprefix("W/"))
+    response = await exporter_client.get("/metrics", headers={"If-None-Match": header})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+@pytest.mark.anyio
+async def test_other_etags_get_the_body(exporter_client):
+    response = await exporter_client.get(
+        "/metrics", headers={"If-None-Match": 'W/"other", "another"'}
+    )
+    assert response.status_code == 200
+    assert "total_users 3.0" in response.text
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("targets", [None, "{}"])
+async def test_fleet_mode_without_targets_fails_at_startup(
+    targets, tmp_path, monkeypatch
+):
+    path = None
+    if targets is not None:
+        path = tmp_path / "targets.json"
+        path.write_text(targets)
+    monkeypatch.setattr(probe, "FLEET_MODE", True)
+    monkeypatch.setattr(probe, "TARGETS_FILE", path)
+    with pytest.raises(Exception, match="at least one target"):
+        async with exporter.lifespan(exporter.app):
+            pass
@@ -0,0 +1,178 @@
+import gzip
+import random
+from collections import Counter
+
+import prometheus_client as prom
+import pytest
+import zstandard
+
+import exposition
+
+
+def text(size: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    lines = "".join(
+        f'user_traffic_bytes{{username="user{rng.randrange(10**6)}"}} {rng.random()}\n'
+        for _ in range(size // 40 + 1)
+    )
+    return lines.encode()[:size]
+
+
+@pytest.mark.parametrize("prefix_size", [0, 1000, 3_000_000])
+@pytest.mark.parametrize("data_size", [0, 5000, 300_000])
+def test_encoded_prefix_and_data_decode_as_one_stream(prefix_size, data_size):
+    prefix, data = text(prefix_size, 1), text(data_size, 2)
+    for name, decompress in (
+        ("gzip", gzip.decompress),
+        # Decodes only the first frame, and needs its content size
+        ("zstd", zstandard.ZstdDecompressor().decompress),
+    ):
+        encoding = exposition.ENCODINGS[name]
+        part = encoding.part(prefix)
+        body = encoding.finish(encoding.join([prefix], [part]), data)
+        assert decompress(body) == prefix + data
+
+
+class Groups:
+    """A collection whose endpoint groups count how often they are rendered."""
+
+    def __init__(self):
+        self.versions = {"system": 1, "users": 1}
+        self.renders = Counter()
+
+    def families(self, name: str):
+        self.renders[name] += 1
+        family = prom.metrics_core.CounterMetricFamily(
+            f"{name}_bytes", name, labels=["key"]
+        )
+        for index in range(1000):
+            family.add_metric([f"{name}{index}"], index * self.versions[name])
+        yield family
+
+    def groups(self):
+        return {
+            name: (version, self.families(name))
+            for name, version in self.versions.items()
+        }
+
+    def collect(self):
+        for _, families in self.groups().values():
+            yield from families
+
+
+DECOMPRESS = {
+    "identity": bytes,
+    "gzip": gzip.decompress,
+    "zstd": zstandard.ZstdDecompressor().decompress,
+}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("fmt", list(exposition.FORMATS))
+async def test_only_refreshed_groups_are_rendered_again(fmt):
+    collection = Groups()
+    cache = exposition.ExpositionCache(collection)
+    live = prom.CollectorRegistry()
+    prom.Gauge("live", "Live", registry=live).set(1)
+
+    async def scrape(encoding: str) -> bytes:
+        body, _ = await exposition.render(cache, live, fmt, encoding)
+        return DECOMPRESS[encoding](body)
+
+    expected = exposition.FORMATS[fmt].generate(collection).removesuffix(
+        exposition.FORMATS[fmt].trailer
+    ) + exposition.FORMATS[fmt].generate(live)
+    for encoding in DECOMPRESS:
+        assert await scrape(encoding) == expected
+    assert collection.renders == {"system": 2, "users": 2}
+
+    collection.versions["system"] += 1
+    expected = exposition.FORMATS[fmt].generate(collection).removesuffix(
+        exposition.FORMATS[fmt].trailer
+    ) + exposition.FORMATS[fmt].generate(live)
+    for encoding in DECOMPRESS:
+        assert await scrape(encoding) == expected
+    # Once for the cache, once more for the expected body
+    assert collection.renders == {"system": 4, "users": 3}
+
+
+PROTOBUF = (
+    "application/vnd.google.protobuf;"
+    "proto=io.prometheus.client.MetricFamily;encoding=delimited"
+)
+
+
+@pytest.mark.parametrize(
+    "accept, fmt",
+    [
+        # Prometheus 2 by default
+        (
+            "application/openmetrics-text;version=1.0.0,"
+            "application/openmetrics-text;version=0.0.1;q=0.75,"
+            "text/plain;version=0.0.4;q=0.5,*/*;q=0.1",
+            "openmetrics",
+        ),
+        # Prometheus 2 with native histograms enabled
+        (
+            f"{PROTOBUF},application/openmetrics-text;version=1.0.0;q=0.8,"
+            "application/openmetrics-text;version=0.0.1;q=0.75,"
+            "text/plain;version=0.0.4;q=0.5,*/*;q=0.1",
+            "protobuf",
+        ),
+        # Prometheus 3 by default
+        (
+            "application/openmetrics-text;version=1.0.0;escaping=allow-utf-8;q=0.5,"
+            "application/openmetrics-text;version=0.0.1;q=0.4,"
+            "text/plain;version=1.0.0;escaping=allow-utf-8;q=0.3,"
+            "text/plain;version=0.0.4;q=0.2,*/*;q=0.1",
+            "openmetrics",
+        ),
+        # scrape_protocols: [PrometheusText0.0.4]
+        ("text/plain;version=0.0.4;q=1,*/*;q=0.1", "text"),
+        ("", "text"),
+        ("*/*", "text"),
+        ("text/*", "text"),
+        ("application/*", "openmetrics"),
+        ("application/json", "text"),
+        ("APPLICATION/OpenMetrics-Text; Version=1.0.0", "openmetrics"),
+        # q=0 refuses a format, even if a wildcard would accept it
+        ("application/openmetrics-text;q=0, */*", "text"),
+        ("text/plain;q=0, */*", "openmetrics"),
+        ("text/plain;q=0, application/openmetrics-text;q=0.1", "openmetrics"),
+        (f"{PROTOBUF};q=0, text/plain;q=0.1", "text"),
+        # Nothing acceptable falls back to the default
+        ("text/plain;q=0", "text"),
+        # Protobuf only as the delimited MetricFamily stream
+        ("application/vnd.google.protobuf", "text"),
+        (PROTOBUF.replace("delimited", "text"), "text"),
+        (PROTOBUF.replace(";", "; ").replace("=", '="') + '"', "protobuf"),
+        # Ties go to the format named rather than matched by a wildcard
+        ("text/*, application/openmetrics-text", "openmetrics"),
+        ("text/plain, application/*", "text"),
+        ("text/plain;q=0.9, application/openmetrics-text;q=0.91", "openmetrics"),
+        ("text/plain;q=bogus, application/openmetrics-text;q=0.1", "openmetrics"),
+    ],
+)
+def test_negotiate_format(accept, fmt):
+    assert exposition.negotiate_format(accept) == fmt
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, encoding",
+    [
+        ("gzip, deflate, br", "gzip"),
+        ("gzip, deflate, br, zstd", "zstd"),
+        ("", "identity"),
+        ("identity", "identity"),
+        ("br", "identity"),
+        ("*", "zstd"),
+        ("*;q=0", "identity"),
+        ("zstd;q=0, *", "gzip"),
+        ("gzip;q=0, *", "zstd"),
+        ("gzip;q=0.5, zstd;q=0.4", "gzip"),
+        ("GZIP", "gzip"),
+        ("gzip;q=0", "identity"),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, encoding):
+    assert exposition.negotiate_encoding(accept_encoding) == encoding
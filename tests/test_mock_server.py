@@ -0,0 +1,55 @@
+import time
+
+import httpx
+import pytest
+
+import mock_server
+
+
+@pytest.fixture
+async def mock_panel():
+    transport = httpx.ASGITransport(app=mock_server.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://panel/api"
+    ) as client:
+        login = await client.post(
+            "/admin/token", data={"username": "admin", "password": "admin"}
+        )
+        client.headers["Authorization"] = f"Bearer {login.json()['access_token']}"
+        yield client
+
+
+@pytest.mark.anyio
+async def test_users_are_paginated(mock_panel):
+    total = mock_server.MOCK_USERS
+    first = (await mock_panel.get("/users", params={"offset": 0, "limit": 10})).json()
+    last = (
+        await mock_panel.get("/users", params={"offset": total - 5, "limit": 10})
+    ).json()
+    assert first["total"] == last["total"] == total
+    assert len(first["users"]) == 10
+    assert [user["username"] for user in last["users"]] == [
+        f"user{index}" for index in range(total - 5, total)
+    ]
+
+
+@pytest.mark.anyio
+async def test_nodes_usage_defaults_to_a_trailing_window(mock_panel):
+    trailing = (await mock_panel.get("/nodes/usage")).json()["usages"]
+    lifetime = (
+        await mock_panel.get("/nodes/usage", params={"start": "2000-01-01T00:00:00"})
+    ).json()["usages"]
+    system = (await mock_panel.get("/system")).json()
+    for window, total in zip(trailing, lifetime):
+        assert 0 < window["downlink"] < total["downlink"]
+    assert system["incoming_bandwidth"] >= sum(usage["downlink"] for usage in lifetime)
+
+
+def test_trailing_window_shrinks_while_lifetime_grows():
+    fleet = mock_server.fleet
+    now = time.time()
+    hours = [now + hour * 3600 for hour in range(48)]
+    trailing = [fleet._seconds(0, when - 30 * 86400, when) for when in hours]
+    lifetime = [fleet._seconds(0, 0, when) for when in hours]
+    assert any(later < earlier for earlier, later in zip(trailing, trailing[1:]))
+    assert all(later > earlier for earlier, later in zip(lifetime, lifetime[1:]))
@@ -0,0 +1,158 @@
+import struct
+from collections import Counter
+
+import prometheus_client as prom
+
+import protobuf
+from counters import CounterState, CumulativeMetricFamily
+from histograms import NATIVE_HISTOGRAM_SCHEMA, DistributionMetricFamily, bucket_index
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    shift = result = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+def unzigzag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def decode(data: bytes) -> dict[int, list]:
+    """Fields of a protobuf message by number: ints, floats or raw bytes."""
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        tag, pos = read_varint(data, pos)
+        field, wire = tag >> 3, tag & 7
+        if wire == 0:
+            value, pos = read_varint(data, pos)
+        elif wire == 1:
+            (value,) = struct.unpack_from("<d", data, pos)
+            pos += 8
+        elif wire == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos : pos + length]
+            pos += length
+        else:
+            raise AssertionError(f"Unexpected wire type {wire}")
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def families(stream: bytes) -> dict[str, dict]:
+    """The delimited MetricFamily messages of a stream, by name."""
+    decoded = {}
+    pos = 0
+    while pos < len(stream):
+        length, pos = read_varint(stream, pos)
+        family = decode(stream[pos : pos + length])
+        pos += length
+        decoded[family[1][0].decode()] = family
+    return decoded
+
+
+def labels(metric: dict) -> dict[str, str]:
+    pairs = (decode(pair) for pair in metric.get(1, []))
+    return {pair[1][0].decode(): pair[2][0].decode() for pair in pairs}
+
+
+def native_buckets(spans: list[bytes], deltas: bytes) -> dict[int, int]:
+    counts, pos, count = [], 0, 0
+    while pos < len(deltas):
+        delta, pos = read_varint(deltas, pos)
+        count += unzigzag(delta)
+        counts.append(count)
+    buckets, index = {}, 0
+    for number, span in enumerate(map(decode, spans)):
+        # The first offset is absolute, the others skip from the last bucket
+        offset = unzigzag(span[1][0])
+        index = offset if number == 0 else index + offset + 1
+        for step in range(span[2][0]):
+            buckets[index + step] = counts[len(buckets)]
+        index += span[2][0] - 1
+    return buckets
+
+
+class Families:
+    def __init__(self, *families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def test_generate_latest_decodes():
+    # A node that appears after the first refresh gets a creation time
+    state = CounterState()
+    CumulativeMetricFamily("node_uplink_bytes", "Uplink", [], state).commit()
+    counter = CumulativeMetricFamily(
+        "node_uplink_bytes", "Uplink", ["node_name"], state
+    )
+    counter.add_total(["node-1"], 1234)
+    gauge = prom.metrics_core.GaugeMetricFamily(
+        "system_memory_used_bytes", "Memory", labels=["host"]
+    )
+    gauge.add_metric(["panel"], 2.5)
+    # 1 to 1.2 fill consecutive buckets, the rest leave gaps between spans
+    values = [0, 1, 1, 1.05, 1.1, 1.2, 3, 3, 3, 100, 5000]
+    histogram = DistributionMetricFamily("users_traffic_bytes", "Traffic", (1, 10))
+    histogram.observe(values)
+    histogram.finish()
+    registry = prom.CollectorRegistry()
+    registry.register(Families(counter, gauge, histogram))
+
+    decoded = families(protobuf.generate_latest(registry))
+    assert list(decoded) == [
+        "node_uplink_bytes_total",
+        "system_memory_used_bytes",
+        "users_traffic_bytes",
+    ]
+
+    family = decoded["node_uplink_bytes_total"]
+    assert family[2] == [b"Uplink"] and family[3] == [protobuf.COUNTER]
+    metric = decode(family[4][0])
+    assert labels(metric) == {"node_name": "node-1"}
+    value = decode(metric[3][0])
+    assert value[1] == [1234.0]
+    created = decode(value[3][0])
+    assert abs(created[1][0] + created.get(2, [0])[0] / 1e9 - counter.now) < 1e-6
+
+    family = decoded["system_memory_used_bytes"]
+    assert family[3] == [protobuf.GAUGE]
+    metric = decode(family[4][0])
+    assert labels(metric) == {"host": "panel"}
+    assert decode(metric[2][0])[1] == [2.5]
+
+    family = decoded["users_traffic_bytes"]
+    assert family[3] == [protobuf.HISTOGRAM]
+    value = decode(decode(family[4][0])[7][0])
+    assert value[1] == [len(values)] and value[2] == [sum(values)]
+    # Classic buckets, without +Inf
+    assert [(decode(b)[1][0], decode(b)[2][0]) for b in value[3]] == [
+        (3, 1.0),
+        (9, 10.0),
+    ]
+    # Native histogram
+    assert unzigzag(value[5][0]) == NATIVE_HISTOGRAM_SCHEMA
+    assert value[7] == [1]
+    expected = Counter(
+        bucket_index(observed, NATIVE_HISTOGRAM_SCHEMA)
+        for observed in values
+        if observed
+    )
+    assert native_buckets(value[12], value[13][0]) == expected
+    assert len(value[12]) > 1 and any(decode(span)[2][0] > 1 for span in value[12])
+    assert 9 not in value and 10 not in value
+
+
+def test_families_without_samples_are_left_out():
+    empty = prom.metrics_core.GaugeMetricFamily("empty", "Nothing", labels=["a"])
+    registry = prom.CollectorRegistry()
+    registry.register(Families(empty))
+    assert protobuf.generate_latest(registry) == b""